@@ -2,6 +2,7 @@ import logging
 import pika
 import pika.exceptions
 import socket
+import time
 
 from ubiops_connector import InputConnector, ConnectorError, RecoverableConnectorError, get_variable, retry
 
@@ -25,6 +26,14 @@ class Deployment(InputConnector):
         # Initialize a connection object. It will be set by the connect method.
         self.connection = None
 
+        # Messages are consumed on a single channel, which is kept open for the lifetime of the deployment. The broker
+        # pushes up to PREFETCH_COUNT unacknowledged messages to the channel ahead of time, and messages are gathered
+        # until MAX_OUTPUT messages are collected or no message arrived for INACTIVITY_TIMEOUT seconds.
+        self.channel = None
+        self.queue = get_variable('QUEUE', 'input_connector')
+        self.prefetch_count = int(get_variable('PREFETCH_COUNT', '100'))
+        self.inactivity_timeout = float(get_variable('INACTIVITY_TIMEOUT', '1'))
+
     def connect(self):
         """
         Connect to RabbitMQ
@@ -53,59 +62,76 @@ class Deployment(InputConnector):
         except (socket.gaierror, pika.exceptions.AMQPError) as e:
             raise RecoverableConnectorError(f"Failed to connect to RabbitMQ: {e}")
 
+    def get_channel(self):
+        """
+        Get the channel to consume messages from, and open it if it is not open yet
+
+        :return: pika.adapters.blocking_connection.BlockingChannel channel: the channel
+        """
+
+        # Include connect() here such that it can benefit from retrying
+        if not self.connection or self.connection.is_closed:
+            self.connect()
+            self.channel = None
+
+        if not self.channel or self.channel.is_closed:
+            self.channel = self.connection.channel()
+            self.channel.basic_qos(prefetch_count=self.prefetch_count)
+
+        return self.channel
+
     @retry(attempts=3)
     def retrieve(self):
         """
-        Retrieve data from RabbitMQ, maximum MAX_OUTPUT messages at a time. Retry when failing due to a lost
-        connection.
+        Retrieve data from RabbitMQ, maximum MAX_OUTPUT messages at a time. The messages are acknowledged at once,
+        before they are returned. Retry when failing due to a lost connection.
 
         :return dict|list: dictionary with the values expected as output of the deployment, or a list of those
             dictionaries
         """
 
-        # Include connect() in the retrieve method such that it can benefit from retrying
-        if not self.connection:
-            self.connect()
-
         data = []
+        delivery_tag = None
+        max_output = int(get_variable('MAX_OUTPUT', '50'))
+        started = time.monotonic()
 
-        # Collect MAX_OUTPUT messages in one call at most
-        for _ in range(0, int(get_variable('MAX_OUTPUT', '50'))):
-            try:
-                channel = self.connection.channel()
-                method_frame, header_frame, body = channel.basic_get('input_connector')
-            except pika.exceptions.AMQPError as e:
-                # If we already collected some messages that were acknowledged, we need to return those now.
-                # Otherwise, these will be lost
-                if len(data) > 0:
-                    logger.warning(f"Failed to acknowledge message: {e}. Returning already collecting messages")
-                    break
+        try:
+            channel = self.get_channel()
 
-                # If nothing was collected yet, we raise an exception to retry
-                self.connection = None
-                raise RecoverableConnectorError(f"Failed to retrieve message from RabbitMQ: {e}")
+            # The consumer stays registered between calls, such that prefetched messages are kept for the next call
+            for method_frame, header_frame, body in channel.consume(
+                    self.queue, inactivity_timeout=self.inactivity_timeout):
+                if method_frame is None:
+                    # No more messages available, end the loop
+                    break
 
-            if method_frame:
                 try:
-                    channel.basic_ack(method_frame.delivery_tag)
-                except pika.exceptions.AMQPError as e:
-                    # If we already collected some messages that were acknowledged, we need to return those now.
-                    # Otherwise, these will be lost
-                    if len(data) > 0:
-                        logger.warning(f"Failed to acknowledge message: {e}. Returning already collecting messages")
-                        break
-
-                    # If nothing was collected yet, we raise an exception to retry
-                    self.connection = None
-                    raise RecoverableConnectorError(f"Failed to acknowledge message: {e}")
+                    message = body.decode('utf-8')
+                except UnicodeDecodeError as e:
+                    # The message cannot be decoded on a redelivery either, so it is rejected without requeueing it.
+                    # It is dead-lettered if the queue has a dead letter exchange. Otherwise, it is discarded.
+                    logger.error(f"Rejected message that is not valid UTF-8: {e}")
+                    channel.basic_reject(method_frame.delivery_tag, requeue=False)
+                    continue
+
+                data.append({'message': message})
+                delivery_tag = method_frame.delivery_tag
+
+                if len(data) >= max_output:
+                    break
 
-                data.append({'message': body.decode('utf-8')})
+            # Acknowledge all collected messages with a single acknowledgement
+            if delivery_tag is not None:
+                channel.basic_ack(delivery_tag, multiple=True)
 
-            else:
-                # No more messages available, end the loop
-                break
+        except pika.exceptions.AMQPError as e:
+            # Messages that were not acknowledged are redelivered by RabbitMQ once the channel is closed, so they are
+            # not returned to prevent them from being processed twice
+            self.stop()
+            raise RecoverableConnectorError(f"Failed to retrieve messages from RabbitMQ: {e}")
 
-        logger.info(f"Retrieved {len(data)} rows")
+        duration = max(time.monotonic() - started, 1e-6)
+        logger.info(f"Retrieved {len(data)} rows in {duration:.3f} seconds")
 
         return data
 
@@ -114,10 +140,17 @@ class Deployment(InputConnector):
         Close connection to RabbitMQ
         """
 
-        # Close the connection. Ignore errors as we do not care about the connection anymore.
+        # Cancel the consumer, such that prefetched messages that were not returned are requeued, and close the
+        # connection. Ignore errors as we do not care about the connection anymore.
+        try:
+            self.channel.cancel()
+        except (AttributeError, pika.exceptions.AMQPError):
+            pass
+
         try:
             self.connection.close()
         except (AttributeError, pika.exceptions.AMQPError):
             pass
 
+        self.channel = None
         self.connection = None
@@ -1,4 +1,14 @@
+import collections
+import concurrent.futures
+import datetime
+import decimal
+import json
 import logging
+import os
+import queue
+import tempfile
+import threading
+import time
 
 import snowflake
 import snowflake.connector.errors
@@ -7,6 +17,22 @@ from ubiops_connector import InputConnector, ConnectorError, RecoverableConnecto
 
 logger = logging.getLogger('Snowflake Connector')
 
+# Fetching the result as Arrow batches requires pyarrow, which is installed with snowflake-connector-python[pandas]
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+OUTPUT_FORMATS = ('records', 'columns')
+
+PARTITION_METHODS = ('hash', 'range')
+
+# Marks the end of a partition in the queue of fetched batches
+PARTITION_DONE = object()
+
+# Placeholder for the watermark in queries that filter on the watermark themselves
+WATERMARK_PLACEHOLDER = '%(watermark)s'
+
 
 class Deployment(InputConnector):
     """
@@ -25,21 +51,90 @@ class Deployment(InputConnector):
         self.database = None
         self.schema = None
 
+        # The result is fetched in batches of at most FETCH_SIZE rows, as Arrow batches when pyarrow is available, such
+        # that the result is never held in memory as both the raw rows and the converted dictionaries
+        self.fetch_size = int(get_variable('FETCH_SIZE', '10000'))
+        self.fetch_arrow = pyarrow is not None and get_variable('FETCH_ARROW', 'true').lower() == 'true'
+
+        # The result is returned as a list of row dictionaries, or as a single dictionary with a list of values for
+        # each column
+        self.output_format = get_variable('OUTPUT_FORMAT', 'records').lower()
+        if self.output_format not in OUTPUT_FORMATS:
+            raise ConnectorError(f"Unknown output format {self.output_format}, expected one of "
+                                 f"{', '.join(OUTPUT_FORMATS)}")
+
+        # Incremental retrieval is enabled when a watermark column is set. Only rows with a value in the watermark
+        # column larger than the largest value of the previous retrieval are then fetched. The watermark is stored in
+        # the watermark file, such that it survives restarts when the file is on persistent storage.
+        self.watermark_column = get_variable('WATERMARK_COLUMN', 'none')
+        if self.watermark_column.lower() == 'none':
+            self.watermark_column = None
+
+        self.watermark_file = get_variable(
+            'WATERMARK_FILE', os.path.join(tempfile.gettempdir(), 'snowflake-watermark.json')
+        )
+        self.watermark = self._load_watermark() if self.watermark_column else None
+
+        # Partitioned retrieval is enabled when the partition count is larger than 1. The query is then split in
+        # slices of the partition column, either by hash or by value range, which are fetched concurrently using a
+        # pool of connections.
+        self.partition_count = int(get_variable('PARTITION_COUNT', '1'))
+        self.partition_column = None
+        if self.partition_count > 1:
+            self.partition_column = get_variable('PARTITION_COLUMN')
+
+        self.partition_method = get_variable('PARTITION_METHOD', 'hash').lower()
+        if self.partition_method not in PARTITION_METHODS:
+            raise ConnectorError(f"Unknown partition method {self.partition_method}, expected one of "
+                                 f"{', '.join(PARTITION_METHODS)}")
+
+        self.partition_concurrency = max(int(get_variable('PARTITION_CONCURRENCY', '4')), 1)
+        self.partition_connections = []
+        self.partition_lock = threading.Lock()
+
+        # Results are cached for RESULT_CACHE_TTL seconds, for each query and its parameters, such that a query that is
+        # repeated within that time is not executed again. The least recently used result is evicted when the cache
+        # contains more than RESULT_CACHE_SIZE results.
+        self.result_cache_ttl = float(get_variable('RESULT_CACHE_TTL', '0'))
+        self.result_cache_size = int(get_variable('RESULT_CACHE_SIZE', '16'))
+        self.result_cache = collections.OrderedDict()
+        self.result_cache_lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
     def connect(self):
         """
         Connect to a Snowflake database based on the environment variables specified.
         """
 
         self.connection = None
+        self.connection = self._create_connection()
+
+    def _create_connection(self):
+        """
+        Create a new connection to the Snowflake database
+
+        :return: snowflake.connector.SnowflakeConnection connection: the connection
+        """
+
         self.database = get_variable('DATABASE')
         self.schema = get_variable('SCHEMA', 'public')
 
+        # The schema, warehouse and role are set when the session is created, instead of with a statement for every
+        # query. The session is kept alive with a heartbeat, such that it does not expire between requests.
+        session = {'database': self.database, 'schema': self.schema}
+        for parameter in ('warehouse', 'role'):
+            value = get_variable(parameter.upper(), 'none')
+            if value.lower() != 'none':
+                session[parameter] = value
+
         try:
-            self.connection = snowflake.connector.connect(
+            return snowflake.connector.connect(
                 user=get_variable('USERNAME'),
                 password=get_variable('PASSWORD'),
                 account=get_variable('ACCOUNT'),
-                database=self.database
+                client_session_keep_alive=get_variable('SESSION_KEEP_ALIVE', 'true').lower() == 'true',
+                **session
             )
         except snowflake.connector.errors.DatabaseError as e:
             raise RecoverableConnectorError(f"Failed to connect to database: {e}")
@@ -49,42 +144,522 @@ class Deployment(InputConnector):
     @retry(attempts=3)
     def retrieve(self):
         """
-        Retrieve data from Snowflake by executing the string query.
+        Retrieve data from Snowflake by executing the string query. The result is fetched in batches and collected in
+        the output format. When the result cache is enabled, a cached result of the same query is returned instead.
 
         :return dict|list: dictionary with the values expected as output of the deployment, or a list of those
             dictionaries
         """
 
-        # Include connect() in the retrieve method such that it can benefit from retrying
+        cache_key = None
+        if self.result_cache_ttl > 0:
+            query, parameters = self._get_statement()
+            cache_key = (query, json.dumps(parameters, default=str, sort_keys=True), self.output_format)
+
+            result = self._get_cached_result(cache_key)
+            if result is not None:
+                logger.info(f"Retrieved result from cache ({self.cache_hits} hits, {self.cache_misses} misses)")
+                return result
+
+        logger.info("Retrieving data")
+        started = time.monotonic()
+
+        if self.output_format == 'columns':
+            result = {}
+            rows = 0
+            for batch in self.retrieve_batches(columnar=True):
+                for column, values in batch.items():
+                    result.setdefault(column, []).extend(values)
+                rows += len(next(iter(batch.values()), []))
+        else:
+            result = []
+            for batch in self.retrieve_batches():
+                result.extend(batch)
+            rows = len(result)
+
+        duration = max(time.monotonic() - started, 1e-6)
+        logger.info(f"Retrieved {rows} rows in {duration:.3f} seconds ({rows / duration:.0f} rows/s)")
+
+        if cache_key is not None:
+            self._cache_result(cache_key, result)
+
+        # Return the result, assuming that the column names returned from the query are matching the deployment
+        # output fields
+        return result
+
+    def _get_cached_result(self, key):
+        """
+        Get a result from the cache, if it was cached less than RESULT_CACHE_TTL seconds ago
+
+        :param tuple key: the query, its parameters and the output format
+        :return dict|list|None: the cached result, or None if the result is not cached
+        """
+
+        with self.result_cache_lock:
+            cached = self.result_cache.get(key)
+            if cached is not None and time.monotonic() - cached[0] < self.result_cache_ttl:
+                self.result_cache.move_to_end(key)
+                self.cache_hits += 1
+                return cached[1]
+
+            if cached is not None:
+                del self.result_cache[key]
+
+            self.cache_misses += 1
+            return None
+
+    def _cache_result(self, key, result):
+        """
+        Store a result in the cache, and evict the least recently used result if the cache is full
+
+        :param tuple key: the query, its parameters and the output format
+        :param dict|list result: the result
+        """
+
+        with self.result_cache_lock:
+            self.result_cache[key] = (time.monotonic(), result)
+            self.result_cache.move_to_end(key)
+
+            while len(self.result_cache) > self.result_cache_size:
+                self.result_cache.popitem(last=False)
+
+    def get_cache_stats(self):
+        """
+        Get the statistics of the result cache
+
+        :return dict: the number of cache hits and misses, the hit ratio and the number of cached results
+        """
+
+        with self.result_cache_lock:
+            lookups = self.cache_hits + self.cache_misses
+            return {
+                'hits': self.cache_hits,
+                'misses': self.cache_misses,
+                'hit_ratio': self.cache_hits / lookups if lookups else 0.0,
+                'size': len(self.result_cache)
+            }
+
+    def retrieve_batches(self, columnar=False):
+        """
+        Execute the string query and yield the result in batches of at most FETCH_SIZE rows. Column names are
+        converted to lower case once for each batch.
+
+        :param bool columnar: whether to yield each batch as a dictionary with a list of values for each column,
+            instead of a list of row dictionaries
+        :return generator: a generator of batches
+        """
+
+        # Include connect() in the retrieval such that it can benefit from retrying
         if not self.connection:
             self.connect()
 
         try:
-            logger.info("Retrieving data")
-            cursor = self.connection.cursor(snowflake.connector.DictCursor)
-            
-            # Use the schema that is specified by the user
-            cursor.execute(f"USE SCHEMA {self.database}.{self.schema}")
-            cursor.execute(self.get_query())
-            result = cursor.fetchall()
+            statement = self._get_statement()
+            if self.partition_count > 1:
+                batches = self._fetch_partitions(statement, columnar)
+            else:
+                batches = self._execute(self.connection, statement, columnar)
 
-            logger.info(f"Retrieved {len(result)} rows")
+            if not self.watermark_column:
+                yield from batches
+                return
 
-            # Convert all database columns to lower case
-            result = [{k.lower(): v for k, v in x.items()} for x in result]
+            watermark = self.watermark
+            for batch in batches:
+                watermark = self._get_max_watermark(batch, watermark)
+                yield batch
 
-            # Return the result, assuming that the column names returned from the query are matching the deployment
-            # output fields
-            return result
+            # The watermark is only advanced once the complete result has been fetched
+            if watermark != self.watermark:
+                self.watermark = watermark
+                self._save_watermark(watermark)
 
         except snowflake.connector.errors.ProgrammingError as e:
             raise ConnectorError(f"Invalid query or schema error: {e}")
         except snowflake.connector.errors.DatabaseError as e:
             raise ConnectorError(f"Error while fetching data: {e}")
 
+    def _execute(self, connection, statement, columnar):
+        """
+        Execute a query and yield its result in batches of at most FETCH_SIZE rows
+
+        :param connection: the connection on which to execute the query
+        :param tuple statement: the query and its parameters
+        :param bool columnar: whether to yield each batch as a dictionary of columns instead of a list of rows
+        :return generator: a generator of batches
+        """
+
+        cursor = connection.cursor()
+
+        try:
+            cursor.execute(*statement)
+
+            batches = self._fetch_arrow_batches(cursor, columnar) if self.fetch_arrow else None
+            if batches is None:
+                batches = self._fetch_batches(cursor, columnar)
+
+            yield from batches
+
+        finally:
+            cursor.close()
+
+    def _fetch_partitions(self, statement, columnar):
+        """
+        Execute the partitions of a query concurrently, each on its own connection, and yield the batches of all
+        partitions as soon as they are fetched
+
+        :param tuple statement: the query and its parameters
+        :param bool columnar: whether to yield each batch as a dictionary of columns instead of a list of rows
+        :return generator: a generator of batches
+        """
+
+        statements = self._get_partition_statements(statement)
+        concurrency = min(self.partition_concurrency, len(statements))
+
+        with self.partition_lock:
+            while len(self.partition_connections) < concurrency:
+                self.partition_connections.append(self._create_connection())
+
+            connections = queue.Queue()
+            for connection in self.partition_connections[:concurrency]:
+                connections.put(connection)
+
+        # The queue of fetched batches is bounded, such that partitions do not get ahead of the consumer
+        batches = queue.Queue(maxsize=concurrency * 2)
+        stopped = threading.Event()
+
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    batches.put(item, timeout=1)
+                    return
+                except queue.Full:
+                    continue
+
+        def fetch_partition(partition_statement):
+            connection = connections.get()
+            try:
+                for batch in self._execute(connection, partition_statement, columnar):
+                    if stopped.is_set():
+                        return
+                    put(batch)
+                put(PARTITION_DONE)
+            except Exception as e:
+                put(e)
+            finally:
+                connections.put(connection)
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+        futures = [executor.submit(fetch_partition, partition_statement) for partition_statement in statements]
+
+        failed = False
+        try:
+            remaining = len(futures)
+            while remaining:
+                item = batches.get()
+                if item is PARTITION_DONE:
+                    remaining -= 1
+                elif isinstance(item, Exception):
+                    failed = True
+                    raise item
+                else:
+                    yield item
+
+        finally:
+            stopped.set()
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+            # The connections may be broken, so they are replaced for the next retrieval
+            if failed:
+                self._close_partition_connections()
+
+    def _get_partition_statements(self, statement):
+        """
+        Split a query in PARTITION_COUNT queries, which each return a slice of the result based on the partition column
+
+        :param tuple statement: the query and its parameters
+        :return list: the query and its parameters for each partition
+        """
+
+        query, parameters = statement
+        query = query.strip().rstrip(';')
+        column = self.partition_column
+
+        if self.partition_method == 'hash':
+            return [
+                (f"SELECT * FROM ({query}) WHERE MOD(ABS(HASH({column})), {self.partition_count}) = {index}",
+                 parameters) for index in range(self.partition_count)
+            ]
+
+        bounds = list(self._execute(
+            self.connection,
+            (f"SELECT MIN({column}) AS lower_bound, MAX({column}) AS upper_bound FROM ({query})", parameters),
+            columnar=False
+        ))[0][0]
+        lower, upper = bounds['lower_bound'], bounds['upper_bound']
+
+        if lower is None:
+            return [(query, parameters)]
+        if not isinstance(lower, (int, float, decimal.Decimal)) or isinstance(lower, bool):
+            raise ConnectorError(f"Range partitioning requires a numeric partition column, use hash partitioning for "
+                                 f"partition column {column}")
+
+        if isinstance(lower, int) and isinstance(upper, int):
+            boundaries = [lower + (upper - lower + 1) * index // self.partition_count
+                          for index in range(1, self.partition_count)]
+        else:
+            boundaries = [lower + (upper - lower) * index / self.partition_count
+                          for index in range(1, self.partition_count)]
+        boundaries = sorted(set(boundaries))
+
+        # The first and last partitions are unbounded, such that they include rows added after fetching the bounds.
+        # Rows without a value in the partition column are included in the first partition.
+        statements = []
+        for index in range(len(boundaries) + 1):
+            conditions = []
+            if index > 0:
+                conditions.append(f"{column} >= {self._format_number(boundaries[index - 1])}")
+            if index < len(boundaries):
+                conditions.append(f"{column} < {self._format_number(boundaries[index])}")
+
+            condition = ' AND '.join(conditions)
+            if index == 0:
+                condition = f"({condition} OR {column} IS NULL)"
+
+            statements.append((f"SELECT * FROM ({query}) WHERE {condition}", parameters))
+
+        return statements
+
+    @staticmethod
+    def _format_number(value):
+        """
+        Format a number as SQL literal
+
+        :param int|float|decimal.Decimal value: the number
+        :return str: the literal
+        """
+
+        if isinstance(value, decimal.Decimal):
+            return format(value, 'f')
+
+        return repr(value)
+
+    def _close_partition_connections(self):
+        """
+        Close the connections used for partitioned retrieval
+        """
+
+        with self.partition_lock:
+            for connection in self.partition_connections:
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+
+            self.partition_connections = []
+
+    def _fetch_arrow_batches(self, cursor, columnar):
+        """
+        Fetch the result of the executed query as Arrow batches, sliced to at most FETCH_SIZE rows
+
+        :param cursor: the cursor that executed the query
+        :param bool columnar: whether to yield each batch as a dictionary of columns instead of a list of rows
+        :return generator|None: a generator of batches, or None if the result cannot be fetched in the Arrow format
+        """
+
+        try:
+            tables = cursor.fetch_arrow_batches()
+        except (snowflake.connector.errors.NotSupportedError, snowflake.connector.errors.ProgrammingError) as e:
+            logger.warning(f"Unable to fetch Arrow batches, falling back to fetching rows: {e}")
+            return None
+
+        def generate():
+            for table in tables:
+                columns = [name.lower() for name in table.column_names]
+
+                for offset in range(0, table.num_rows, self.fetch_size):
+                    # Arrow stores the data by column, so values are converted column by column
+                    values = [column.to_pylist() for column in table.slice(offset, self.fetch_size).columns]
+
+                    if columnar:
+                        yield dict(zip(columns, values))
+                    else:
+                        yield [dict(zip(columns, row)) for row in zip(*values)]
+
+        return generate()
+
+    def _fetch_batches(self, cursor, columnar):
+        """
+        Fetch the result of the executed query in batches of at most FETCH_SIZE rows
+
+        :param cursor: the cursor that executed the query
+        :param bool columnar: whether to yield each batch as a dictionary of columns instead of a list of rows
+        :return generator: a generator of batches
+        """
+
+        columns = [column[0].lower() for column in cursor.description]
+
+        while True:
+            rows = cursor.fetchmany(self.fetch_size)
+            if not rows:
+                break
+
+            if columnar:
+                yield dict(zip(columns, [list(values) for values in zip(*rows)]))
+            else:
+                yield [dict(zip(columns, row)) for row in rows]
+
+    def _get_statement(self):
+        """
+        Get the query to execute and its parameters. When incremental retrieval is enabled and a watermark is known,
+        the query is filtered on the watermark column, unless it contains the watermark placeholder itself.
+
+        :return tuple: the query and its parameters, which are None if the query has no parameters
+        """
+
+        query = self.get_query()
+
+        if not self.watermark_column:
+            return query, None
+
+        if WATERMARK_PLACEHOLDER in query:
+            if self.watermark is None:
+                raise ConnectorError("The query contains a watermark placeholder, but no watermark is known. Set "
+                                     "WATERMARK_START to the initial watermark.")
+            return query, {'watermark': self.watermark}
+
+        # The result is ordered by the watermark column, unless it is merged from partitions
+        query = query.strip().rstrip(';')
+        order = f" ORDER BY {self.watermark_column}" if self.partition_count <= 1 else ''
+
+        if self.watermark is None:
+            return f"SELECT * FROM ({query}){order}", None
+
+        # Percent signs in the query are escaped, as the parameters are bound using the pyformat style
+        return f"SELECT * FROM ({query.replace('%', '%%')}) WHERE {self.watermark_column} > %(watermark)s{order}", \
+            {'watermark': self.watermark}
+
+    def _get_max_watermark(self, batch, watermark):
+        """
+        Get the largest value of the watermark column in the batch
+
+        :param dict|list batch: a batch of the result, either columnar or a list of rows
+        :param watermark: the largest value of the watermark column so far
+        :return: the largest value of the watermark column
+        """
+
+        column = self.watermark_column.lower()
+        if isinstance(batch, dict):
+            values = batch.get(column, [])
+        else:
+            values = [row.get(column) for row in batch]
+
+        # The query only returns rows beyond the previous watermark, so any value in the batch is larger. The previous
+        # watermark is therefore not compared, as WATERMARK_START is a string rather than a value of the column.
+        values = [value for value in values if value is not None]
+        if watermark is not None and values and type(watermark) is type(values[0]):
+            values.append(watermark)
+
+        try:
+            return max(values, default=watermark)
+        except TypeError as e:
+            raise ConnectorError(f"Values of watermark column {self.watermark_column} cannot be compared: {e}")
+
+    def _load_watermark(self):
+        """
+        Load the stored watermark. A watermark that was stored for a different query or watermark column is ignored.
+        Without a stored watermark, the watermark is taken from the WATERMARK_START environment variable.
+
+        :return: the watermark, or None if there is no watermark
+        """
+
+        try:
+            with open(self.watermark_file) as file:
+                state = json.load(file)
+
+            if state.get('query') == self.get_query() and state.get('column') == self.watermark_column:
+                logger.info(f"Continuing from watermark {state['value']}")
+                return self._decode_watermark(state['type'], state['value'])
+
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Failed to load watermark: {e}")
+
+        start = get_variable('WATERMARK_START', 'none')
+        return None if start.lower() == 'none' else start
+
+    def _save_watermark(self, watermark):
+        """
+        Store the watermark. The file is replaced atomically, such that an interrupted write does not corrupt it.
+
+        :param watermark: the watermark to store
+        """
+
+        value_type, value = self._encode_watermark(watermark)
+        state = {'query': self.get_query(), 'column': self.watermark_column, 'type': value_type, 'value': value}
+
+        try:
+            with open(f"{self.watermark_file}.tmp", 'w') as file:
+                json.dump(state, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(f"{self.watermark_file}.tmp", self.watermark_file)
+
+        except OSError as e:
+            logger.warning(f"Failed to store watermark: {e}")
+
+    @staticmethod
+    def _encode_watermark(watermark):
+        """
+        Encode a watermark such that it can be stored as JSON without losing its type
+
+        :param watermark: the watermark
+        :return tuple: the name of the type and the value as string
+        """
+
+        if isinstance(watermark, datetime.datetime):
+            return 'datetime', watermark.isoformat()
+        if isinstance(watermark, datetime.date):
+            return 'date', watermark.isoformat()
+        if isinstance(watermark, bool):
+            return 'str', str(watermark)
+        if isinstance(watermark, int):
+            return 'int', str(watermark)
+        if isinstance(watermark, float):
+            return 'float', repr(watermark)
+        if isinstance(watermark, decimal.Decimal):
+            return 'decimal', str(watermark)
+
+        return 'str', str(watermark)
+
+    @staticmethod
+    def _decode_watermark(value_type, value):
+        """
+        Decode a stored watermark
+
+        :param str value_type: the name of the type of the watermark
+        :param str value: the value of the watermark
+        :return: the watermark
+        """
+
+        decoders = {
+            'datetime': datetime.datetime.fromisoformat,
+            'date': datetime.date.fromisoformat,
+            'int': int,
+            'float': float,
+            'decimal': decimal.Decimal,
+            'str': str
+        }
+
+        return decoders[value_type](value)
+
     def stop(self):
         """
-        Close connection to the database if the connection has been initialised
+        Close connection to the database if the connection has been initialised, and the connections used for
+        partitioned retrieval
         """
 
         try:
@@ -93,6 +668,7 @@ class Deployment(InputConnector):
             pass
 
         self.connection = None
+        self._close_partition_connections()
 
     @staticmethod
     def get_query():
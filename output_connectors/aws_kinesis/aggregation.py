@@ -0,0 +1,291 @@
+import gzip
+import hashlib
+import zlib
+
+
+# Aggregated records start with these magic bytes and end with the MD5 digest of the protobuf message in between, as
+# defined by the Kinesis Producer Library (KPL)
+MAGIC = b'\xf3\x89\x9a\xc2'
+DIGEST_SIZE = 16
+
+# Protobuf wire types
+VARINT = 0
+FIXED64 = 1
+LENGTH_DELIMITED = 2
+FIXED32 = 5
+
+# Field numbers of the AggregatedRecord message
+PARTITION_KEY_TABLE = 1
+RECORDS = 3
+
+# Field numbers of the Record message
+PARTITION_KEY_INDEX = 1
+DATA = 3
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def _encode_varint(value):
+    """
+    Encode an unsigned integer as a protobuf varint
+
+    :param int value: the integer to encode
+    :return bytes: the encoded integer
+    """
+
+    encoded = bytearray()
+    while value > 0x7f:
+        encoded.append((value & 0x7f) | 0x80)
+        value >>= 7
+    encoded.append(value)
+
+    return bytes(encoded)
+
+
+def _decode_varint(data, position):
+    """
+    Decode a protobuf varint
+
+    :param bytes data: the data containing the varint
+    :param int position: the position of the first byte of the varint
+    :return tuple: the decoded integer and the position after the varint
+    """
+
+    value = 0
+    shift = 0
+    while True:
+        if position >= len(data):
+            raise ValueError("Truncated varint in aggregated record")
+
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+
+        if not byte & 0x80:
+            return value, position
+
+
+def _encode_bytes(field_number, value):
+    """
+    Encode a length-delimited protobuf field
+
+    :param int field_number: the number of the field
+    :param bytes value: the value of the field
+    :return bytes: the encoded field
+    """
+
+    return _encode_varint(field_number << 3 | LENGTH_DELIMITED) + _encode_varint(len(value)) + value
+
+
+def _decode_fields(data):
+    """
+    Decode the fields of a protobuf message
+
+    :param bytes data: the encoded message
+    :return list: a list of (field number, value) tuples, where the value is an integer or bytes
+    """
+
+    fields = []
+    position = 0
+
+    while position < len(data):
+        key, position = _decode_varint(data, position)
+        field_number, wire_type = key >> 3, key & 0x7
+
+        if wire_type == VARINT:
+            value, position = _decode_varint(data, position)
+        elif wire_type == LENGTH_DELIMITED:
+            length, position = _decode_varint(data, position)
+            value = data[position:position + length]
+            position += length
+        elif wire_type == FIXED64:
+            value = data[position:position + 8]
+            position += 8
+        elif wire_type == FIXED32:
+            value = data[position:position + 4]
+            position += 4
+        else:
+            raise ValueError(f"Unsupported wire type {wire_type} in aggregated record")
+
+        fields.append((field_number, value))
+
+    return fields
+
+
+def compress(data, compression):
+    """
+    Compress the given data
+
+    :param bytes data: the data to compress
+    :param str|None compression: the compression to use, either 'zlib', 'gzip' or None
+    :return bytes: the compressed data
+    """
+
+    if compression == 'zlib':
+        return zlib.compress(data)
+    if compression == 'gzip':
+        return gzip.compress(data)
+
+    return data
+
+
+def decompress(data):
+    """
+    Decompress the given data if it was compressed using zlib or gzip. Since uncompressed data may start with the same
+    bytes as a compressed stream, data that cannot be decompressed is returned unchanged.
+
+    :param bytes data: the data to decompress
+    :return bytes: the decompressed data, or the given data if it is not compressed
+    """
+
+    try:
+        if data[:2] == GZIP_MAGIC:
+            return gzip.decompress(data)
+
+        # A zlib stream starts with a header of which the compression method is 8 and that is a multiple of 31
+        if len(data) >= 2 and data[0] & 0x0f == 8 and (data[0] << 8 | data[1]) % 31 == 0:
+            return zlib.decompress(data)
+
+    except (zlib.error, OSError, EOFError):
+        pass
+
+    return data
+
+
+class RecordAggregator:
+    """
+    Aggregates multiple user records into Kinesis records in the KPL aggregation format
+    """
+
+    def __init__(self, max_bytes=51200, compression=None):
+        """
+        :param int max_bytes: maximum size of an aggregated record before compression
+        :param str|None compression: the compression to apply to aggregated records, either 'zlib', 'gzip' or None
+        """
+
+        self.max_bytes = max_bytes
+        self.compression = compression
+
+        self.partition_keys = {}
+        self.explicit_hash_key = None
+        self.records = []
+        self.size = len(MAGIC) + DIGEST_SIZE
+
+    def __len__(self):
+        return len(self.records)
+
+    def add(self, record):
+        """
+        Add a user record to the aggregated record. If the aggregated record would become too large, it is completed
+        first and a new aggregated record is started.
+
+        :param dict record: a Kinesis record containing the keys 'Data', 'PartitionKey' and optionally
+            'ExplicitHashKey'
+        :return list: the aggregated records that were completed, as Kinesis records
+        """
+
+        completed = []
+
+        partition_key = record['PartitionKey'].encode('utf-8')
+        encoded = self._encode_record(record, self.partition_keys.get(partition_key, len(self.partition_keys)))
+        size = len(encoded)
+        if partition_key not in self.partition_keys:
+            size += len(_encode_bytes(PARTITION_KEY_TABLE, partition_key))
+
+        if self.records and self.size + size > self.max_bytes:
+            completed = self.flush()
+            encoded = self._encode_record(record, 0)
+            size = len(encoded) + len(_encode_bytes(PARTITION_KEY_TABLE, partition_key))
+
+        if not self.records:
+            self.explicit_hash_key = record.get('ExplicitHashKey')
+        if partition_key not in self.partition_keys:
+            self.partition_keys[partition_key] = len(self.partition_keys)
+
+        self.records.append(encoded)
+        self.size += size
+
+        return completed
+
+    def flush(self):
+        """
+        Complete the aggregated record
+
+        :return list: the completed aggregated record as Kinesis record, or an empty list if no records were added
+        """
+
+        if not self.records:
+            return []
+
+        partition_keys = list(self.partition_keys)
+        explicit_hash_key = self.explicit_hash_key
+
+        message = b''.join(
+            [_encode_bytes(PARTITION_KEY_TABLE, partition_key) for partition_key in partition_keys] + self.records
+        )
+        data = MAGIC + message + hashlib.md5(message).digest()
+
+        self.partition_keys = {}
+        self.explicit_hash_key = None
+        self.records = []
+        self.size = len(MAGIC) + DIGEST_SIZE
+
+        # The aggregated record is published using the partition key and explicit hash key of its first user record
+        record = {'Data': compress(data, self.compression), 'PartitionKey': partition_keys[0].decode('utf-8')}
+        if explicit_hash_key is not None:
+            record['ExplicitHashKey'] = explicit_hash_key
+
+        return [record]
+
+    @staticmethod
+    def _encode_record(record, partition_key_index):
+        """
+        Encode a user record as a Record message, including the field key of the AggregatedRecord message
+
+        :param dict record: a Kinesis record containing the keys 'Data' and 'PartitionKey'
+        :param int partition_key_index: the index of the partition key in the partition key table
+        :return bytes: the encoded record
+        """
+
+        data = record['Data']
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+
+        message = _encode_varint(PARTITION_KEY_INDEX << 3 | VARINT) + _encode_varint(partition_key_index) + \
+            _encode_bytes(DATA, data)
+
+        return _encode_bytes(RECORDS, message)
+
+
+def deaggregate(data, partition_key=None):
+    """
+    Decode the data of a Kinesis record into the user records it contains. Compressed data is decompressed first. Data
+    that is not in the KPL aggregation format is returned as a single user record.
+
+    :param bytes data: the data of a Kinesis record
+    :param str partition_key: the partition key of the Kinesis record
+    :return list: a list of dictionaries containing the keys 'Data' and 'PartitionKey' of each user record
+    """
+
+    data = decompress(data)
+
+    if not data.startswith(MAGIC) or len(data) < len(MAGIC) + DIGEST_SIZE:
+        return [{'Data': data, 'PartitionKey': partition_key}]
+
+    message, digest = data[len(MAGIC):-DIGEST_SIZE], data[-DIGEST_SIZE:]
+    if hashlib.md5(message).digest() != digest:
+        raise ValueError("Checksum of aggregated record does not match")
+
+    partition_keys = []
+    records = []
+
+    for field_number, value in _decode_fields(message):
+        if field_number == PARTITION_KEY_TABLE:
+            partition_keys.append(value.decode('utf-8'))
+
+        elif field_number == RECORDS:
+            fields = dict(_decode_fields(value))
+            records.append((fields.get(PARTITION_KEY_INDEX, 0), fields.get(DATA, b'')))
+
+    return [{'Data': record_data, 'PartitionKey': partition_keys[index]} for index, record_data in records]
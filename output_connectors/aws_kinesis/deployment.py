@@ -1,14 +1,43 @@
+import bisect
 import boto3
 import botocore.exceptions
+import hashlib
+import itertools
 import json
 import logging
 import random
-import string
+import threading
+import time
 
 from ubiops_connector import OutputConnector, ConnectorError, RecoverableConnectorError, get_variable, retry
 
+from aggregation import RecordAggregator
+
 logger = logging.getLogger('Amazon Kinesis Stream Connector')
 
+# Limits of a single PutRecords request
+MAX_BATCH_RECORDS = 500
+MAX_BATCH_BYTES = 5 * 1024 * 1024
+
+# Maximum length of a partition key
+MAX_PARTITION_KEY_LENGTH = 256
+
+# Maximum size of the data and partition key of a single record
+MAX_RECORD_BYTES = 1024 * 1024
+
+# Error codes of requests and records that may succeed when they are retried. Other errors, such as a validation error
+# or a missing stream, fail again on every retry.
+RETRYABLE_ERRORS = frozenset({
+    'ProvisionedThroughputExceededException',
+    'LimitExceededException',
+    'ThrottlingException',
+    'KMSThrottlingException',
+    'InternalFailure',
+    'ServiceUnavailable',
+})
+
+PARTITION_KEY_STRATEGIES = ('random', 'field', 'hash', 'shards')
+
 
 class Deployment(OutputConnector):
 
@@ -23,6 +52,49 @@ class Deployment(OutputConnector):
         # Setup Kinesis client
         self.kinesis_client = self.setup()
 
+        # The partition key of a record is either random, taken from an input field, a hash of input fields, or chosen
+        # round-robin over the shards of the stream
+        self.partition_key_strategy = get_variable('PARTITION_KEY_STRATEGY', 'random').lower()
+        if self.partition_key_strategy not in PARTITION_KEY_STRATEGIES:
+            raise ConnectorError(f"Unknown partition key strategy {self.partition_key_strategy}, expected one of "
+                                 f"{', '.join(PARTITION_KEY_STRATEGIES)}")
+
+        self.partition_key_fields = []
+        if self.partition_key_strategy in ('field', 'hash'):
+            self.partition_key_fields = [
+                field.strip() for field in get_variable('PARTITION_KEY_FIELDS').split(',') if field.strip()
+            ]
+
+        # The hash key ranges of the open shards are cached, and refreshed periodically to follow resharding
+        self.shard_cache_ttl = float(get_variable('SHARD_CACHE_TTL', '300'))
+        self.shards = None
+        self.shards_updated = None
+        self.shards_lock = threading.Lock()
+        self.shard_counter = itertools.count()
+
+        # Buffered inserts are enabled when the batch size is larger than 1. Records are then collected in the buffer
+        # and published using PutRecords once the batch is full or the oldest record exceeds the maximum age.
+        self.batch_size = int(get_variable('BATCH_SIZE', '1'))
+        self.batch_max_age = float(get_variable('BATCH_MAX_AGE', '5'))
+        self.buffer = []
+        self.buffer_rows = 0
+        self.buffer_started = None
+        self.buffer_lock = threading.Lock()
+        self.flush_timer = None
+
+        # When aggregation is enabled, buffered records are packed into aggregated records in the KPL format, which can
+        # optionally be compressed. Unless partition keys are random, records are aggregated per shard, such that all
+        # records of a partition key keep ending up in the same shard.
+        self.aggregation = get_variable('AGGREGATION', 'false').lower() == 'true'
+        self.aggregation_max_bytes = int(get_variable('AGGREGATION_MAX_BYTES', '51200'))
+        compression = get_variable('COMPRESSION', 'none').lower()
+        self.compression = compression if compression in ('zlib', 'gzip') else None
+        self.aggregators = {}
+
+        # Records rejected by PutRecords, for example due to throttling, are retried with an exponential backoff
+        self.max_retries = int(get_variable('MAX_RETRIES', '3'))
+        self.retry_interval = int(get_variable('RETRY_INTERVAL', '100')) / 1000
+
     def setup(self):
         """
         Connect to Amazon Kinesis Stream
@@ -40,30 +112,339 @@ class Deployment(OutputConnector):
         except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
             raise ConnectorError(f"Failed to initialise Kinesis client {e}")
 
-    @retry(attempts=3)
+    def _to_record(self, data):
+        """
+        Convert the input data dictionary to a single Kinesis record, with a partition key according to the partition
+        key strategy
+
+        :param dict data: a dictionary containing the data to be inserted
+        :return dict: the Kinesis record
+        """
+
+        record = {'Data': json.dumps(data).encode('utf-8')}
+
+        if self.partition_key_strategy == 'field':
+            field = self.partition_key_fields[0]
+            if data.get(field) is None or data[field] == '':
+                raise ConnectorError(f"Partition key field {field} is missing")
+
+            partition_key = str(data[field])
+            if len(partition_key) > MAX_PARTITION_KEY_LENGTH:
+                partition_key = hashlib.md5(partition_key.encode('utf-8')).hexdigest()
+
+            record['PartitionKey'] = partition_key
+
+        elif self.partition_key_strategy == 'hash':
+            values = json.dumps([data.get(field) for field in self.partition_key_fields], default=str)
+            record['PartitionKey'] = hashlib.md5(values.encode('utf-8')).hexdigest()
+
+        elif self.partition_key_strategy == 'shards':
+            # The explicit hash key overrides the hash of the partition key, and routes the record to the shard
+            shards = self._get_shards()
+            starting_hash_key, shard_id = shards[next(self.shard_counter) % len(shards)]
+            record['PartitionKey'] = shard_id
+            record['ExplicitHashKey'] = str(starting_hash_key)
+
+        else:
+            record['PartitionKey'] = f"{random.getrandbits(64):016x}"
+
+        size = len(record['Data']) + len(record['PartitionKey'].encode('utf-8'))
+        if size > MAX_RECORD_BYTES:
+            raise ConnectorError(f"Record of {size} bytes exceeds the maximum record size of {MAX_RECORD_BYTES} bytes")
+
+        return record
+
+    def _get_shards(self):
+        """
+        Get the open shards of the stream, sorted by their starting hash key. The shards are cached for
+        SHARD_CACHE_TTL seconds.
+
+        :return list: a list of (starting hash key, shard ID) tuples
+        """
+
+        with self.shards_lock:
+            if self.shards is not None and time.monotonic() - self.shards_updated < self.shard_cache_ttl:
+                return self.shards
+
+            shards = []
+            try:
+                response = self.kinesis_client.list_shards(StreamName=get_variable('STREAM'))
+                while True:
+                    for shard in response['Shards']:
+                        # Closed shards, which are the parents of resharded shards, have an ending sequence number
+                        if 'EndingSequenceNumber' not in shard['SequenceNumberRange']:
+                            shards.append((int(shard['HashKeyRange']['StartingHashKey']), shard['ShardId']))
+
+                    if not response.get('NextToken'):
+                        break
+                    response = self.kinesis_client.list_shards(NextToken=response['NextToken'])
+
+            except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+                if self.shards is None:
+                    raise ConnectorError(f"Failed to list shards: {e}")
+
+                # Keep using the previous shards, as records with an explicit hash key of a closed shard are still
+                # routed to its child shards
+                logger.warning(f"Failed to refresh shards, using cached shards: {e}")
+                self.shards_updated = time.monotonic()
+                return self.shards
+
+            if not shards:
+                raise ConnectorError("Stream does not contain any open shards")
+
+            self.shards = sorted(shards)
+            self.shards_updated = time.monotonic()
+            logger.info(f"Found {len(self.shards)} open shards")
+
+            return self.shards
+
+    def _aggregate(self, record):
+        """
+        Add a record to the aggregated record of its shard
+
+        :param dict record: the Kinesis record
+        :return list: the aggregated records that were completed
+        """
+
+        shard_id = None
+        if self.partition_key_strategy != 'random':
+            if 'ExplicitHashKey' not in record:
+                hash_key = int(hashlib.md5(record['PartitionKey'].encode('utf-8')).hexdigest(), 16)
+                record['ExplicitHashKey'] = str(hash_key)
+
+            # The shard is the last shard with a starting hash key smaller than or equal to the hash key of the record
+            shards = self._get_shards()
+            index = bisect.bisect_left(shards, (int(record['ExplicitHashKey']) + 1,)) - 1
+            shard_id = shards[max(index, 0)][1]
+
+        if shard_id not in self.aggregators:
+            self.aggregators[shard_id] = RecordAggregator(
+                max_bytes=self.aggregation_max_bytes, compression=self.compression
+            )
+
+        return self.aggregators[shard_id].add(record)
+
     def insert(self, data):
         """
-        Insert given data to Kinesis stream
+        Insert given data to Kinesis stream. A list of dictionaries is published as a single batch. When buffered
+        inserts are enabled, the data is added to the buffer and the buffer is flushed once it is full or too old.
+
+        :param dict|list data: a dictionary containing the data to be inserted, or a list of those dictionaries
+        """
+
+        if isinstance(data, dict) and self.batch_size <= 1:
+            self.insert_record(data)
+            return
+
+        records = [self._to_record(row) for row in (data if isinstance(data, list) else [data])]
+
+        with self.buffer_lock:
+            if not self.buffer_rows:
+                self.buffer_started = time.monotonic()
+            self.buffer_rows += len(records)
+
+            if self.aggregation:
+                for record in records:
+                    self.buffer.extend(self._aggregate(record))
+            else:
+                self.buffer.extend(records)
+
+            age = time.monotonic() - self.buffer_started
+            full = self.buffer_rows >= self.batch_size or age >= self.batch_max_age
+            self._schedule_flush(self.batch_max_age - age)
+
+        if full:
+            self.flush()
+
+    def _schedule_flush(self, delay):
+        """
+        Start a background timer that flushes the buffer once the oldest buffered record reaches the maximum age, such
+        that the records are published when no more data arrives. Must be called while holding the buffer lock.
+
+        :param float delay: number of seconds after which the timer fires
+        """
+
+        if self.flush_timer is None:
+            self.flush_timer = threading.Timer(max(delay, 0), self._flush_on_timer)
+            self.flush_timer.daemon = True
+            self.flush_timer.start()
+
+    def _flush_on_timer(self):
+        """
+        Flush the buffer if its oldest record reached the maximum age. Otherwise, the buffer was flushed and refilled
+        since the timer was started, and the timer is restarted for the remaining time of the current buffer.
+        """
+
+        with self.buffer_lock:
+            self.flush_timer = None
+            if not self.buffer_rows:
+                return
+
+            remaining = self.batch_max_age - (time.monotonic() - self.buffer_started)
+            if remaining > 0:
+                self._schedule_flush(remaining)
+                return
+
+        try:
+            self.flush()
+        except ConnectorError as e:
+            logger.error(f"Failed to publish buffered records: {e}")
+
+        # Records that could not be published are retried once the maximum age has passed again
+        with self.buffer_lock:
+            if self.buffer_rows:
+                self._schedule_flush(self.batch_max_age)
+
+    @retry(attempts=3)
+    def insert_record(self, data):
+        """
+        Insert given data to Kinesis stream as a single record
 
         :param dict data: a dictionary containing the data to be inserted
         """
 
-        # Convert the input data dictionary to a single Kinesis record. Generate the partition key randomly.
-        record = {
-            'Data': json.dumps(data),
-            'PartitionKey': ''.join(random.sample(
-                string.ascii_uppercase + string.ascii_lowercase + string.digits, 16
-            ))
-        }
+        record = self._to_record(data)
 
         try:
-            self.kinesis_client.put_record(
-                StreamName=get_variable('STREAM'),
-                Data=record['Data'],
-                PartitionKey=record['PartitionKey']
-            )
+            self.kinesis_client.put_record(StreamName=get_variable('STREAM'), **record)
 
-        except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
-            raise RecoverableConnectorError(f"Failed to insert record: {e.response['Error']['Message']}")
+        except botocore.exceptions.ClientError as e:
+            if self._is_retryable(e):
+                raise RecoverableConnectorError(f"Failed to insert record: {e}")
+            raise ConnectorError(f"Failed to insert record: {e}")
+
+        except botocore.exceptions.BotoCoreError as e:
+            raise RecoverableConnectorError(f"Failed to insert record: {e}")
 
         logger.info("Data inserted successfully")
+
+    @retry(attempts=3)
+    def flush(self):
+        """
+        Publish all buffered records to the Kinesis stream using PutRecords requests. Records that are rejected are
+        retried with an exponential backoff, without publishing the accepted records again. Records that are still
+        rejected after the last retry remain in the buffer. Records that fail with an error that is not retryable are
+        discarded.
+        """
+
+        with self.buffer_lock:
+            for aggregator in self.aggregators.values():
+                self.buffer.extend(aggregator.flush())
+
+            if not self.buffer:
+                return
+
+            stream = get_variable('STREAM')
+            total = len(self.buffer)
+            started = time.monotonic()
+            discarded = []
+
+            for attempt in range(self.max_retries + 1):
+                if attempt > 0:
+                    # Exponential backoff with full jitter, to spread the retries of throttled records
+                    time.sleep(random.uniform(0, self.retry_interval * 2 ** (attempt - 1)))
+
+                batches = self._split_batches(self.buffer)
+                rejected = []
+                error = None
+
+                for index, batch in enumerate(batches):
+                    try:
+                        response = self.kinesis_client.put_records(StreamName=stream, Records=batch)
+
+                    except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+                        # None of the records in this request were published, so the request can be retried as a whole.
+                        # A request that fails with an error that is not retryable is discarded.
+                        retryable = not isinstance(e, botocore.exceptions.ClientError) or self._is_retryable(e)
+                        self.buffer = rejected + [
+                            record for remaining in batches[index if retryable else index + 1:] for record in remaining
+                        ]
+                        self.buffer_rows = len(self.buffer)
+                        if not retryable:
+                            raise ConnectorError(f"Failed to insert {len(batch)} records: {e}")
+                        raise RecoverableConnectorError(f"Failed to insert records: {e}")
+
+                    if response.get('FailedRecordCount', 0) > 0:
+                        for record, result in zip(batch, response['Records']):
+                            if 'ErrorCode' in result:
+                                error = f"{result['ErrorCode']}: {result.get('ErrorMessage')}"
+                                if result['ErrorCode'] in RETRYABLE_ERRORS:
+                                    rejected.append(record)
+                                else:
+                                    discarded.append(error)
+                                    logger.error(f"Discarded record ({error})")
+
+                self.buffer = rejected
+                if not rejected:
+                    break
+
+                logger.warning(f"{len(rejected)} records were rejected ({error}), attempt {attempt + 1} of "
+                               f"{self.max_retries + 1}")
+
+            self.buffer_rows = len(self.buffer)
+
+            if self.buffer:
+                raise RecoverableConnectorError(f"Failed to insert {len(self.buffer)} of {total} records: {error}")
+
+            self.buffer_started = None
+
+        duration = time.monotonic() - started
+        logger.info(f"Inserted {total - len(discarded)} records in {duration:.3f} seconds")
+
+        if discarded:
+            raise ConnectorError(f"Failed to insert {len(discarded)} of {total} records: {discarded[0]}")
+
+    @staticmethod
+    def _is_retryable(error):
+        """
+        Check whether the request that raised the given error may succeed when it is retried
+
+        :param botocore.exceptions.ClientError error: the error raised by the Kinesis client
+        :return bool: whether the request can be retried
+        """
+
+        return error.response.get('Error', {}).get('Code') in RETRYABLE_ERRORS
+
+    @staticmethod
+    def _split_batches(records):
+        """
+        Split the given records in batches that fit within the record count and size limits of PutRecords
+
+        :param list records: the Kinesis records
+        :return list: a list of batches, each a list of records
+        """
+
+        batches = []
+        batch = []
+        batch_bytes = 0
+
+        for record in records:
+            size = len(record['Data']) + len(record['PartitionKey'].encode('utf-8'))
+
+            if batch and (len(batch) >= MAX_BATCH_RECORDS or batch_bytes + size > MAX_BATCH_BYTES):
+                batches.append(batch)
+                batch = []
+                batch_bytes = 0
+
+            batch.append(record)
+            batch_bytes += size
+
+        if batch:
+            batches.append(batch)
+
+        return batches
+
+    def stop(self):
+        """
+        Publish the remaining buffered records
+        """
+
+        with self.buffer_lock:
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+
+        try:
+            self.flush()
+        except ConnectorError as e:
+            logger.error(f"Failed to publish buffered records on stop: {e}")
@@ -1,14 +1,75 @@
 import boto3
 import boto3.exceptions
+import boto3.s3.transfer
+import botocore.config
 import botocore.exceptions
+import collections
+import concurrent.futures
+import glob
+import hashlib
+import io
 import logging
+import math
 import os
+import s3transfer.utils
+import threading
+import time
 
 from ubiops_connector import OutputConnector, ConnectorError, RecoverableConnectorError, get_variable, retry
 
 
 logger = logging.getLogger('Amazon S3 Connector')
 
+MB = 1024 * 1024
+
+# Size of the blocks in which files are read to compute their hash
+HASH_BLOCK_SIZE = MB
+
+
+class BytesReader(io.RawIOBase):
+    """
+    Seekable file object that reads from a bytes-like object without copying it
+    """
+
+    def __init__(self, data):
+        """
+        :param bytes|bytearray|memoryview data: the data to read
+        """
+
+        super().__init__()
+        self.view = memoryview(data).cast('B')
+        self.position = 0
+
+    def __len__(self):
+        return len(self.view)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = max(min(len(buffer), len(self.view) - self.position), 0)
+        buffer[:size] = self.view[self.position:self.position + size]
+        self.position += size
+        return size
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+
+        self.position = offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
 
 class Deployment(OutputConnector):
 
@@ -20,12 +81,32 @@ class Deployment(OutputConnector):
 
         OutputConnector.__init__(self, base_directory, context)
 
-        # Setup the client
+        # Setup the client and the transfer manager. The transfer manager uploads all files, and the parts of large
+        # files, concurrently using a bounded pool of threads that share the client.
+        self.max_concurrency = int(get_variable('MAX_CONCURRENCY', '10'))
         self.s3_client = self.setup()
+        self.transfer_config = boto3.s3.transfer.TransferConfig(
+            multipart_threshold=int(float(get_variable('MULTIPART_THRESHOLD', '8')) * MB),
+            multipart_chunksize=int(float(get_variable('MULTIPART_CHUNKSIZE', '8')) * MB),
+            max_concurrency=self.max_concurrency
+        )
+        self.transfer_manager = boto3.s3.transfer.create_transfer_manager(self.s3_client, self.transfer_config)
+
+        # Files are not uploaded when the object in S3 already has the same content, which is determined by comparing
+        # the ETag computed from the file with the ETag of the last upload to the same object path, or optionally with
+        # the ETag of the object in S3
+        self.deduplication = get_variable('DEDUPLICATION', 'false').lower() == 'true'
+        self.deduplication_head = get_variable('DEDUPLICATION_HEAD', 'false').lower() == 'true'
+        self.etag_cache_size = int(get_variable('ETAG_CACHE_SIZE', '10000'))
+        self.etag_cache = collections.OrderedDict()
+        self.etag_cache_lock = threading.Lock()
+        self.skipped = 0
+        self.skipped_bytes = 0
 
     def setup(self):
         """
-        Setup the S3 client
+        Setup the S3 client. The connection pool of the client is as large as the maximum number of concurrent
+        requests.
 
         :return: boto3.client client: the client representing the S3 storage
         """
@@ -35,15 +116,16 @@ class Deployment(OutputConnector):
                 service_name='s3',
                 region_name=get_variable('REGION'),
                 aws_access_key_id=get_variable('ACCESS_KEY'),
-                aws_secret_access_key=get_variable('SECRET_KEY')
+                aws_secret_access_key=get_variable('SECRET_KEY'),
+                config=botocore.config.Config(max_pool_connections=self.max_concurrency)
             )
         except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
             raise ConnectorError(f"Failed to initialise S3 client {e}")
 
-    @retry(attempts=3)
     def insert(self, data):
         """
-        Insert given data to S3 storage
+        Insert given data to S3 storage. The field 'blob' contains a file path, a directory, a glob pattern or a list
+        of those. It can also contain bytes or a file-like object, which are uploaded without writing them to disk.
 
         :param dict data: a dictionary containing the data to be inserted
         """
@@ -52,23 +134,267 @@ class Deployment(OutputConnector):
         if 'blob' not in data:
             raise ConnectorError("Field 'blob' is not given in the input")
 
-        file_path = data['blob']
-        filename = os.path.basename(file_path)
+        path_prefix = get_variable('PATH_PREFIX', '')
+
+        if isinstance(data['blob'], (bytes, bytearray, memoryview)) or hasattr(data['blob'], 'read'):
+            fileobj = data['blob'] if hasattr(data['blob'], 'read') else BytesReader(data['blob'])
+            object_path = os.path.join(path_prefix, self._get_filename(data)).replace(os.sep, '/')
+
+            # A seekable stream is rewound to its current position when the upload is retried
+            position = fileobj.tell() if fileobj.seekable() else None
+            self.upload_fileobj(fileobj, object_path, position)
+            return
+
+        # Generate the object path by concatenating (optional) path prefix and the path of the file relative to the
+        # given directory or glob pattern
+        files = [
+            (file_path, os.path.join(path_prefix, relative_path).replace(os.sep, '/'))
+            for file_path, relative_path in self._resolve_files(data['blob'])
+        ]
+        if not files:
+            raise ConnectorError(f"No files found for blob {data['blob']}")
+
+        self.upload_files(files)
+
+    @staticmethod
+    def _get_filename(data):
+        """
+        Get the filename of a blob that is given as bytes or file-like object, from the field 'filename' or from the
+        name of the file object
+
+        :param dict data: a dictionary containing the data to be inserted
+        :return str: the filename
+        """
+
+        filename = data.get('filename') or getattr(data['blob'], 'name', None)
+        if not isinstance(filename, str) or not filename:
+            raise ConnectorError("Field 'filename' is required when the blob is not a file path")
+
+        return os.path.basename(filename)
+
+    @staticmethod
+    def _resolve_files(blob):
+        """
+        Resolve the files to upload
+
+        :param str|list blob: a file path, a directory, a glob pattern or a list of those
+        :return list: a list of (file path, relative path) tuples
+        """
+
+        if isinstance(blob, (list, tuple)):
+            return [file for path in blob for file in Deployment._resolve_files(path)]
+
+        if os.path.isdir(blob):
+            return [
+                (os.path.join(directory, filename), os.path.relpath(os.path.join(directory, filename), blob))
+                for directory, _, filenames in os.walk(blob) for filename in sorted(filenames)
+            ]
+
+        if glob.has_magic(blob):
+            # Paths are relative to the directory before the first component that contains a wildcard
+            parts = blob.split(os.sep)
+            root = os.sep.join(parts[:next(index for index, part in enumerate(parts) if glob.has_magic(part))])
+            return [
+                (file_path, os.path.relpath(file_path, root or os.curdir))
+                for file_path in sorted(glob.glob(blob, recursive=True)) if os.path.isfile(file_path)
+            ]
+
+        return [(blob, os.path.basename(blob))]
+
+    @retry(attempts=3)
+    def upload_files(self, files):
+        """
+        Upload the given files to S3 storage concurrently. Files that were uploaded successfully are removed from the
+        given list, such that a retry only uploads the files that failed.
+
+        :param list files: a list of (file path, object path) tuples
+        """
 
         bucket = get_variable('BUCKET')
-        path_prefix = get_variable('PATH_PREFIX', '')
+        started = time.monotonic()
+
+        etags = {}
+        skipped = set()
+        if self.deduplication:
+            etags, skipped = self._deduplicate(bucket, files)
+            files[:] = [file for file in files if file not in skipped]
+
+        # Large files are split into parts, that are uploaded in parallel with the other files
+        futures = [
+            (file_path, object_path, self.transfer_manager.upload(file_path, bucket, object_path))
+            for file_path, object_path in files
+        ]
+
+        failed = []
+        size = 0
+        error = None
+        for file_path, object_path, future in futures:
+            try:
+                future.result()
+                size += os.path.getsize(file_path)
+
+                if object_path in etags:
+                    self._cache_etag(bucket, object_path, etags[object_path])
+
+            except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+                failed.append((file_path, object_path))
+                error = e
+            except (OSError, boto3.exceptions.S3UploadFailedError) as e:
+                raise ConnectorError(f"Failed to insert blob {file_path}: {e}")
 
-        # Generate the object path by concatenating (optional) path prefix and filename
-        object_path = os.path.join(path_prefix, filename)
+        uploaded = len(files) - len(failed)
+        files[:] = failed
+
+        duration = max(time.monotonic() - started, 1e-6)
+        if uploaded:
+            logger.info(f"Inserted {uploaded} blobs ({size / MB:.1f} MB) in {duration:.3f} seconds "
+                        f"({size / MB / duration:.1f} MB/s)")
+
+        if skipped:
+            skipped_bytes = sum(os.path.getsize(file_path) for file_path, _ in skipped)
+            self.skipped += len(skipped)
+            self.skipped_bytes += skipped_bytes
+            logger.info(f"Skipped {len(skipped)} unchanged blobs ({skipped_bytes / MB:.1f} MB), {self.skipped} blobs "
+                        f"({self.skipped_bytes / MB:.1f} MB) in total")
+
+        if failed:
+            raise RecoverableConnectorError(f"Failed to insert {len(failed)} blobs: {error}")
+
+    @retry(attempts=3)
+    def upload_fileobj(self, fileobj, object_path, position=None):
+        """
+        Upload the given file object to S3 storage. Large file objects are uploaded in parts, that are read from the
+        file object one part at a time.
+
+        :param fileobj: the file object to upload
+        :param str object_path: the path of the object
+        :param int|None position: the position in the file object to upload from, or None if it is not seekable
+        """
+
+        if position is not None:
+            fileobj.seek(position)
 
         try:
-            # The upload_file method accepts a file name, a bucket name, and an object name. The method handles large
-            # files by splitting them into smaller chunks and uploading each chunk in parallel.
-            self.s3_client.upload_file(file_path, bucket, object_path)
+            self.transfer_manager.upload(fileobj, get_variable('BUCKET'), object_path).result()
 
         except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+            # A stream that is not seekable cannot be uploaded again
+            if position is None:
+                raise ConnectorError(f"Failed to insert blob: {e}")
             raise RecoverableConnectorError(f"Failed to insert blob: {e}")
-        except boto3.exceptions.S3UploadFailedError as e:
-            raise ConnectorError(f"Failed to insert blob: {e}")
 
         logger.info("Blob inserted successfully")
+
+    def _deduplicate(self, bucket, files):
+        """
+        Compute the ETags of the given files and determine which files are already present in S3 storage
+
+        :param str bucket: the name of the bucket
+        :param list files: a list of (file path, object path) tuples
+        :return tuple: a dictionary of the ETag of each object path, and a set of the files that can be skipped
+        """
+
+        def check(file):
+            file_path, object_path = file
+            etag = self._compute_etag(file_path)
+
+            with self.etag_cache_lock:
+                existing_etag = self.etag_cache.get((bucket, object_path))
+
+            if existing_etag is None and self.deduplication_head:
+                existing_etag = self._get_etag(bucket, object_path)
+
+            return etag, existing_etag
+
+        # Files are hashed and checked concurrently, as hashlib releases the GIL while hashing
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            results = list(executor.map(check, files))
+
+        etags = {}
+        skipped = set()
+        for (file_path, object_path), (etag, existing_etag) in zip(files, results):
+            etags[object_path] = etag
+
+            if etag == existing_etag:
+                skipped.add((file_path, object_path))
+                self._cache_etag(bucket, object_path, etag)
+
+        return etags, skipped
+
+    def _compute_etag(self, file_path):
+        """
+        Compute the ETag that S3 assigns to the object when the file is uploaded with the transfer configuration. This
+        is the MD5 hash of the file, or for a multipart upload the MD5 hash of the MD5 hashes of the parts followed by
+        the number of parts.
+
+        :param str file_path: the path of the file
+        :return str: the ETag, without quotes
+        """
+
+        size = os.path.getsize(file_path)
+        multipart = size >= self.transfer_config.multipart_threshold
+        part_size = s3transfer.utils.ChunksizeAdjuster().adjust_chunksize(
+            self.transfer_config.multipart_chunksize, size
+        ) if multipart else max(size, 1)
+
+        part_hashes = []
+        with open(file_path, 'rb') as file:
+            for _ in range(max(math.ceil(size / part_size), 1)):
+                part_hash = hashlib.md5()
+                remaining = part_size
+                while remaining > 0:
+                    block = file.read(min(HASH_BLOCK_SIZE, remaining))
+                    if not block:
+                        break
+                    part_hash.update(block)
+                    remaining -= len(block)
+
+                part_hashes.append(part_hash.digest())
+
+        if not multipart:
+            return part_hashes[0].hex()
+
+        return f"{hashlib.md5(b''.join(part_hashes)).hexdigest()}-{len(part_hashes)}"
+
+    def _get_etag(self, bucket, object_path):
+        """
+        Get the ETag of an object in S3 storage
+
+        :param str bucket: the name of the bucket
+        :param str object_path: the path of the object
+        :return str|None: the ETag, without quotes, or None if the object does not exist
+        """
+
+        try:
+            return self.s3_client.head_object(Bucket=bucket, Key=object_path)['ETag'].strip('"')
+
+        except botocore.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey', 'NotFound'):
+                logger.warning(f"Failed to get ETag of {object_path}: {e}")
+        except botocore.exceptions.BotoCoreError as e:
+            logger.warning(f"Failed to get ETag of {object_path}: {e}")
+
+        return None
+
+    def _cache_etag(self, bucket, object_path, etag):
+        """
+        Store the ETag of an object in the cache, and evict the least recently used object if the cache is full
+
+        :param str bucket: the name of the bucket
+        :param str object_path: the path of the object
+        :param str etag: the ETag of the object
+        """
+
+        with self.etag_cache_lock:
+            self.etag_cache[(bucket, object_path)] = etag
+            self.etag_cache.move_to_end((bucket, object_path))
+
+            while len(self.etag_cache) > self.etag_cache_size:
+                self.etag_cache.popitem(last=False)
+
+    def stop(self):
+        """
+        Wait for running uploads and shut down the transfer manager
+        """
+
+        self.transfer_manager.shutdown()
@@ -1,13 +1,72 @@
+import asyncio
+import concurrent.futures
+import glob
+import hashlib
+import io
+import math
 import os
 import logging
+import threading
+import time
 
 import azure.storage.blob
+import azure.storage.blob.aio
 import azure.core.exceptions
 
 from ubiops_connector import OutputConnector, ConnectorError, RecoverableConnectorError, get_variable, retry
 
 logger = logging.getLogger('Azure Blob Storage Connector')
 
+MB = 1024 * 1024
+
+# Maximum number of blocks of a block blob
+MAX_BLOCKS = 50000
+
+
+class BytesReader(io.RawIOBase):
+    """
+    Seekable file object that reads from a bytes-like object without copying it
+    """
+
+    def __init__(self, data):
+        """
+        :param bytes|bytearray|memoryview data: the data to read
+        """
+
+        super().__init__()
+        self.view = memoryview(data).cast('B')
+        self.position = 0
+
+    def __len__(self):
+        return len(self.view)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = max(min(len(buffer), len(self.view) - self.position), 0)
+        buffer[:size] = self.view[self.position:self.position + size]
+        self.position += size
+        return size
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+
+        self.position = offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
 
 class Deployment(OutputConnector):
 
@@ -19,9 +78,22 @@ class Deployment(OutputConnector):
 
         OutputConnector.__init__(self, base_directory, context)
 
+        # Blobs larger than the single put size are uploaded in blocks, using multiple concurrent requests
+        self.block_size = int(float(get_variable('BLOCK_SIZE', '4')) * MB)
+        self.max_single_put_size = int(float(get_variable('MAX_SINGLE_PUT_SIZE', '64')) * MB)
+        self.max_concurrency = int(get_variable('MAX_CONCURRENCY', '4'))
+        self.timeout = int(get_variable('TIMEOUT', '10'))
+
         # Setup the Azure blob client
         self.blob_service_client = self.setup()
 
+        # Multiple files are uploaded concurrently with the asynchronous client, which runs in an event loop in a
+        # separate thread. The client, and its HTTP session, are created on first use and shared by all requests.
+        self.max_concurrent_blobs = int(get_variable('MAX_CONCURRENT_BLOBS', '64'))
+        self.loop = None
+        self.loop_lock = threading.Lock()
+        self.async_blob_service_client = None
+
     def setup(self):
         """
         Setup the Azure Blob Storage client
@@ -31,15 +103,18 @@ class Deployment(OutputConnector):
 
         try:
             return azure.storage.blob.BlobServiceClient.from_connection_string(
-                conn_str=get_variable('CONNECTION_STRING', '')
+                conn_str=get_variable('CONNECTION_STRING', ''),
+                max_block_size=self.block_size,
+                max_single_put_size=self.max_single_put_size
             )
         except azure.core.exceptions.AzureError as e:
             raise ConnectorError(f"Failed to initialise Azure Storage client: {e}")
 
-    @retry(attempts=3)
     def insert(self, data):
         """
-        Insert given data to Azure Blob Storage
+        Insert given data to Azure Blob Storage. The field 'blob' contains a file path, bytes or a file-like object.
+        Bytes and file objects are uploaded without writing them to disk. It can also contain a directory, a glob
+        pattern or a list of those, of which the files are uploaded concurrently.
 
         :param dict data: a dictionary containing the data to be inserted
         """
@@ -48,8 +123,166 @@ class Deployment(OutputConnector):
         if 'blob' not in data:
             raise ConnectorError("Field 'blob' is not given in the input")
 
-        file_path = data['blob']
-        filename = os.path.basename(file_path)
+        if isinstance(data['blob'], (bytes, bytearray, memoryview)) or hasattr(data['blob'], 'read'):
+            stream = data['blob'] if hasattr(data['blob'], 'read') else BytesReader(data['blob'])
+            filename = data.get('filename') or getattr(stream, 'name', None)
+            if not isinstance(filename, str) or not filename:
+                raise ConnectorError("Field 'filename' is required when the blob is not a file path")
+
+            # A seekable stream is rewound to its current position when the upload is retried
+            position = stream.tell() if stream.seekable() else None
+            self.upload(stream, os.path.basename(filename), position)
+            return
+
+        if isinstance(data['blob'], (list, tuple)) or os.path.isdir(data['blob']) or glob.has_magic(data['blob']):
+            files = self._resolve_files(data['blob'])
+            if not files:
+                raise ConnectorError(f"No files found for blob {data['blob']}")
+
+            self.upload_files(files)
+            return
+
+        self.upload(data['blob'], os.path.basename(data['blob']))
+
+    @staticmethod
+    def _resolve_files(blob):
+        """
+        Resolve the files to upload
+
+        :param str|list blob: a file path, a directory, a glob pattern or a list of those
+        :return list: a list of (file path, relative path) tuples
+        """
+
+        if isinstance(blob, (list, tuple)):
+            return [file for path in blob for file in Deployment._resolve_files(path)]
+
+        if os.path.isdir(blob):
+            return [
+                (os.path.join(directory, filename), os.path.relpath(os.path.join(directory, filename), blob))
+                for directory, _, filenames in os.walk(blob) for filename in sorted(filenames)
+            ]
+
+        if glob.has_magic(blob):
+            # Paths are relative to the directory before the first component that contains a wildcard
+            parts = blob.split(os.sep)
+            root = os.sep.join(parts[:next(index for index, part in enumerate(parts) if glob.has_magic(part))])
+            return [
+                (file_path, os.path.relpath(file_path, root or os.curdir))
+                for file_path in sorted(glob.glob(blob, recursive=True)) if os.path.isfile(file_path)
+            ]
+
+        return [(blob, os.path.basename(blob))]
+
+    @retry(attempts=3)
+    def upload_files(self, files):
+        """
+        Upload the given files to Azure Blob Storage. Files up to the single put size are uploaded concurrently using
+        the asynchronous client, larger files are uploaded one by one in blocks. Files that were uploaded successfully
+        are removed from the given list, such that a retry only uploads the files that failed.
+
+        :param list files: a list of (file path, filename) tuples
+        """
+
+        started = time.monotonic()
+        small_files = []
+        large_files = []
+        for file in files:
+            if os.path.getsize(file[0]) <= self.max_single_put_size:
+                small_files.append(file)
+            else:
+                large_files.append(file)
+
+        failed = []
+        if small_files:
+            failed = self._run(self._upload_files_async(small_files))
+
+        for file_path, filename in large_files:
+            blob_client = self.blob_service_client.get_blob_client(
+                container=get_variable('CONTAINER'), blob=os.path.join(get_variable('PATH_PREFIX', ''), filename)
+            )
+            try:
+                self._upload_staged(blob_client, file_path)
+            except azure.core.exceptions.AzureError as e:
+                failed.append(((file_path, filename), e))
+
+        failed_files = [file for file, _ in failed]
+        size = sum(os.path.getsize(file[0]) for file in files if file not in failed_files)
+        uploaded = len(files) - len(failed)
+        files[:] = failed_files
+
+        duration = max(time.monotonic() - started, 1e-6)
+        logger.info(f"Inserted {uploaded} blobs ({size / MB:.1f} MB) in {duration:.3f} seconds "
+                    f"({uploaded / duration:.0f} blobs/s, {size / MB / duration:.1f} MB/s)")
+
+        if failed:
+            raise RecoverableConnectorError(f"Failed to insert {len(failed)} blobs: {failed[-1][1]}")
+
+    async def _upload_files_async(self, files):
+        """
+        Upload the given files concurrently using the asynchronous client. The number of concurrent uploads is bounded
+        by a semaphore.
+
+        :param list files: a list of (file path, filename) tuples
+        :return list: a list of (file, error) tuples of the files that failed to upload
+        """
+
+        if self.async_blob_service_client is None:
+            self.async_blob_service_client = azure.storage.blob.aio.BlobServiceClient.from_connection_string(
+                conn_str=get_variable('CONNECTION_STRING', ''),
+                max_block_size=self.block_size,
+                max_single_put_size=self.max_single_put_size
+            )
+
+        container = get_variable('CONTAINER')
+        path_prefix = get_variable('PATH_PREFIX', '')
+        semaphore = asyncio.BoundedSemaphore(self.max_concurrent_blobs)
+
+        async def upload(file_path, filename):
+            async with semaphore:
+                blob_client = self.async_blob_service_client.get_blob_client(
+                    container=container, blob=os.path.join(path_prefix, filename)
+                )
+                with open(file_path, "rb") as data:
+                    await blob_client.upload_blob(data=data, timeout=self.timeout)
+
+        results = await asyncio.gather(*[upload(*file) for file in files], return_exceptions=True)
+
+        failed = []
+        for file, result in zip(files, results):
+            if isinstance(result, azure.core.exceptions.AzureError):
+                failed.append((file, result))
+            elif isinstance(result, Exception):
+                raise ConnectorError(f"Failed to insert blob {file[0]}: {result}")
+
+        return failed
+
+    def _run(self, coroutine):
+        """
+        Run a coroutine in the event loop of the asynchronous client, and wait for its result. The event loop is
+        started on first use.
+
+        :param coroutine: the coroutine to run
+        :return: the result of the coroutine
+        """
+
+        with self.loop_lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    @retry(attempts=3)
+    def upload(self, source, filename, position=None):
+        """
+        Upload a file or stream to Azure Blob Storage. Large files and streams are uploaded in blocks, that are read
+        from the stream one block at a time. Large files are staged block by block, such that a retry only uploads the
+        blocks that are missing.
+
+        :param str|io.IOBase source: the path of the file or the stream to upload
+        :param str filename: the filename of the blob
+        :param int|None position: the position in the stream to upload from, or None if it is not seekable
+        """
 
         path_prefix = get_variable('PATH_PREFIX', '')
 
@@ -61,10 +294,104 @@ class Deployment(OutputConnector):
                 container=get_variable('CONTAINER'), blob=object_path
             )
 
-            with open(file_path, "rb") as data:
-                blob_client.upload_blob(data=data,  timeout=int(get_variable('TIMEOUT', '10')))
+            if isinstance(source, str) and os.path.getsize(source) > self.max_single_put_size:
+                self._upload_staged(blob_client, source)
+            elif isinstance(source, str):
+                with open(source, "rb") as data:
+                    blob_client.upload_blob(data=data, max_concurrency=self.max_concurrency, timeout=self.timeout)
+            else:
+                length = None
+                if position is not None:
+                    length = source.seek(0, io.SEEK_END) - position
+                    source.seek(position)
+                blob_client.upload_blob(
+                    data=source, length=length, max_concurrency=self.max_concurrency, timeout=self.timeout
+                )
 
         except azure.core.exceptions.AzureError as e:
+            # A stream that is not seekable cannot be uploaded again
+            if not isinstance(source, str) and position is None:
+                raise ConnectorError(f"Failed to insert blob: {e}")
             raise RecoverableConnectorError(f"Failed to insert blob: {e}")
 
         logger.info("Blob inserted successfully")
+
+    def _upload_staged(self, blob_client, file_path):
+        """
+        Upload a file by staging its blocks concurrently and committing the block list. The IDs of the blocks are
+        derived from the file, such that blocks that were already staged by a previous attempt are not uploaded again.
+
+        :param azure.storage.blob.BlobClient blob_client: the client of the destination blob
+        :param str file_path: the path of the file to upload
+        """
+
+        stat = os.stat(file_path)
+        size = stat.st_size
+        block_size = max(self.block_size, math.ceil(size / MAX_BLOCKS))
+
+        # Block IDs must have the same length for all blocks of a blob
+        key = f"{os.path.abspath(file_path)}:{size}:{stat.st_mtime_ns}:{block_size}"
+        token = hashlib.md5(key.encode('utf-8')).hexdigest()[:16]
+        blocks = [
+            (f"{token}-{index:05d}", offset, min(block_size, size - offset))
+            for index, offset in enumerate(range(0, size, block_size))
+        ]
+
+        # Uncommitted blocks are kept by Azure for a week, so they also survive a restart of the deployment
+        staged = self._get_staged_blocks(blob_client)
+        missing = [(block_id, offset, length) for block_id, offset, length in blocks if staged.get(block_id) != length]
+
+        def stage_block(block_id, offset, length):
+            with open(file_path, 'rb') as file:
+                file.seek(offset)
+                blob_client.stage_block(block_id=block_id, data=file.read(length), length=length, timeout=self.timeout)
+
+        started = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            futures = [executor.submit(stage_block, *block) for block in missing]
+
+            # Wait for all blocks, such that the blocks that succeeded are skipped when the upload is retried
+            concurrent.futures.wait(futures)
+            for future in futures:
+                future.result()
+
+        blob_client.commit_block_list(
+            [azure.storage.blob.BlobBlock(block_id=block_id) for block_id, _, _ in blocks], timeout=self.timeout
+        )
+
+        uploaded = sum(length for _, _, length in missing)
+        duration = max(time.monotonic() - started, 1e-6)
+        logger.info(f"Uploaded {len(missing)} of {len(blocks)} blocks ({uploaded / MB:.1f} MB) in {duration:.3f} "
+                    f"seconds ({uploaded / MB / duration:.1f} MB/s)")
+
+    @staticmethod
+    def _get_staged_blocks(blob_client):
+        """
+        Get the blocks of a blob that are staged but not committed yet
+
+        :param azure.storage.blob.BlobClient blob_client: the client of the blob
+        :return dict: the size of each staged block by block ID
+        """
+
+        try:
+            _, uncommitted = blob_client.get_block_list(block_list_type='uncommitted')
+        except azure.core.exceptions.ResourceNotFoundError:
+            return {}
+
+        return {block.id: block.size for block in uncommitted}
+
+    def stop(self):
+        """
+        Close the asynchronous client and stop its event loop
+        """
+
+        if self.loop is None:
+            return
+
+        if self.async_blob_service_client is not None:
+            try:
+                self._run(self.async_blob_service_client.close())
+            except azure.core.exceptions.AzureError:
+                pass
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
@@ -1,14 +1,23 @@
+import concurrent.futures
 import json
 import logging
+import requests
 import tempfile
+import threading
+import time
+import uuid
 
 from google.cloud import bigquery
-from google.api_core.exceptions import GoogleAPIError, NotFound
+from google.api_core.exceptions import BadRequest, GoogleAPIError, NotFound
 
 from ubiops_connector import OutputConnector, ConnectorError, RecoverableConnectorError, get_variable, retry
 
 logger = logging.getLogger('BigQuery Connector')
 
+MB = 1024 * 1024
+
+WRITE_MODES = ('streaming', 'load')
+
 
 class Deployment(OutputConnector):
 
@@ -26,6 +35,39 @@ class Deployment(OutputConnector):
         # Setup the client
         self.client = self.setup()
 
+        # Table metadata is cached for each table, to avoid a metadata request for every insert
+        self.table_cache_ttl = float(get_variable('TABLE_CACHE_TTL', '300'))
+        self.tables = {}
+        self.tables_lock = threading.Lock()
+
+        # In streaming mode, buffered inserts are enabled when the batch size is larger than 1. Rows are then collected
+        # in the buffer and inserted with a single streaming insert request once the batch is full, too large or the
+        # oldest row exceeds the maximum age. In load mode, rows are collected in a newline delimited JSON spool file,
+        # which is loaded into the table with a load job.
+        self.write_mode = get_variable('WRITE_MODE', 'streaming').lower()
+        if self.write_mode not in WRITE_MODES:
+            raise ConnectorError(f"Unknown write mode {self.write_mode}, expected one of {', '.join(WRITE_MODES)}")
+
+        load = self.write_mode == 'load'
+        self.batch_size = int(get_variable('BATCH_SIZE', '100000' if load else '1'))
+        self.batch_max_size = int(float(get_variable('BATCH_MAX_SIZE', '100' if load else '5')) * MB)
+        self.batch_max_age = float(get_variable('BATCH_MAX_AGE', '300' if load else '5'))
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.buffer_started = None
+        self.buffer_lock = threading.Lock()
+        self.flush_timer = None
+
+        # The spool file of load mode and the number of rows it contains. When a load job is submitted, the spool file
+        # becomes the pending file, and new rows are written to a new spool file until the load job has succeeded.
+        self.spool = None
+        self.spool_rows = 0
+        self.pending_spool = None
+        self.pending_rows = 0
+        self.pending_job_id = None
+        self.pending_job_location = None
+        self.load_timeout = float(get_variable('LOAD_TIMEOUT', '300'))
+
     def setup(self):
         """
         Setup the BigQuery client
@@ -40,34 +82,383 @@ class Deployment(OutputConnector):
         except (json.decoder.JSONDecodeError, TypeError) as e:
             raise ConnectorError(f"Failed to initialise BigQuery client: {e}")
 
-    @retry(attempts=3)
     def insert(self, data):
         """
-        Insert given data to BigQuery
+        Insert given data to BigQuery. A list of rows is inserted as a single batch. When buffered inserts or load
+        mode are enabled, the data is added to the buffer and the buffer is flushed once it is full or too old.
+
+        :param dict|list data: a dictionary containing the data to be inserted, or a list of those dictionaries
+        """
+
+        # Every row gets a unique insert ID, which BigQuery uses to ignore rows that are inserted again on a retry
+        if isinstance(data, dict) and self.batch_size <= 1 and self.write_mode == 'streaming':
+            self.insert_row(data, row_id=uuid.uuid4().hex)
+            return
+
+        rows = data if isinstance(data, list) else [data]
+
+        with self.buffer_lock:
+            if not self.buffer and not self.spool_rows:
+                self.buffer_started = time.monotonic()
+
+            if self.write_mode == 'load':
+                if self.spool is None:
+                    self.spool = tempfile.TemporaryFile()
+                for row in rows:
+                    line = (json.dumps(row, default=str) + '\n').encode('utf-8')
+                    self.spool.write(line)
+                    self.buffer_bytes += len(line)
+                self.spool_rows += len(rows)
+            else:
+                for row in rows:
+                    size = len(json.dumps(row, default=str))
+                    self.buffer.append((row, uuid.uuid4().hex, size))
+                    self.buffer_bytes += size
+
+            rows_buffered = len(self.buffer) + self.spool_rows + self.pending_rows
+            age = time.monotonic() - self.buffer_started
+            full = rows_buffered >= self.batch_size or self.buffer_bytes >= self.batch_max_size \
+                or age >= self.batch_max_age
+            self._schedule_flush(self.batch_max_age - age)
+
+        if full:
+            self.flush()
+
+    def _schedule_flush(self, delay):
+        """
+        Start a background timer that flushes the buffer once the oldest buffered row reaches the maximum age, such
+        that the rows are inserted when no more data arrives. Must be called while holding the buffer lock.
+
+        :param float delay: number of seconds after which the timer fires
+        """
+
+        if self.flush_timer is None:
+            self.flush_timer = threading.Timer(max(delay, 0), self._flush_on_timer)
+            self.flush_timer.daemon = True
+            self.flush_timer.start()
+
+    def _flush_on_timer(self):
+        """
+        Flush the buffer if its oldest row reached the maximum age. Otherwise, the buffer was flushed and refilled
+        since the timer was started, and the timer is restarted for the remaining time of the current buffer. A
+        pending file of a failed load job is loaded again without waiting.
+        """
+
+        with self.buffer_lock:
+            self.flush_timer = None
+            if not self.buffer and not self.spool_rows and self.pending_spool is None:
+                return
+
+            if self.buffer_started is not None:
+                remaining = self.batch_max_age - (time.monotonic() - self.buffer_started)
+                if remaining > 0:
+                    self._schedule_flush(remaining)
+                    return
+
+        try:
+            self.flush()
+        except ConnectorError as e:
+            logger.error(f"Failed to insert buffered rows: {e}")
+
+        # Rows that could not be inserted are retried once the maximum age has passed again
+        with self.buffer_lock:
+            if self.buffer or self.spool_rows or self.pending_spool is not None:
+                self._schedule_flush(self.batch_max_age)
+
+    @retry(attempts=3)
+    def insert_row(self, data, row_id=None):
+        """
+        Insert a single row to BigQuery
 
         :param dict data: a dictionary containing the data to be inserted
+        :param str row_id: the insert ID of the row
         """
 
         # Initialize table
         table_name = f"{get_variable('DATASET')}.{get_variable('TABLE')}"
 
         try:
-            table = self.client.get_table(table_name)
-            error = self.client.insert_rows(table=table, rows=[data])
+            table = self._get_table(table_name, columns=data.keys())
+            error = self.client.insert_rows(table=table, rows=[data], row_ids=[row_id] if row_id else None)
         except NotFound:
+            self._invalidate_table(table_name)
             raise ConnectorError(f"Table {table_name} was not found")
         except (ValueError, TypeError, GoogleAPIError) as e:
+            self._invalidate_table(table_name)
             raise ConnectorError(f"Failed to insert data: {e}")
 
         if error:
+            # Invalid rows may be caused by a change of the schema, so fetch the table again when retrying
+            if any(row_error.get('reason') == 'invalid' for row in error for row_error in row['errors']):
+                self._invalidate_table(table_name)
+
             message = error[0]['errors'][0]['message']
             raise RecoverableConnectorError(f"Failed to insert data: {message}")
 
         logger.info("Data inserted successfully")
 
+    @retry(attempts=3)
+    def flush(self):
+        """
+        Insert all buffered rows to BigQuery, using streaming inserts or a load job depending on the write mode
+        """
+
+        with self.buffer_lock:
+            if not self.buffer and not self.spool_rows and self.pending_spool is None:
+                return
+
+            table_name = f"{get_variable('DATASET')}.{get_variable('TABLE')}"
+            total = len(self.buffer) + self.spool_rows + self.pending_rows
+            started = time.monotonic()
+
+            if self.write_mode == 'load':
+                self._flush_load(table_name)
+            else:
+                self._flush_streaming(table_name)
+
+            self.buffer = []
+            self.buffer_bytes = 0
+            self.buffer_started = None
+
+        duration = max(time.monotonic() - started, 1e-6)
+        logger.info(f"Inserted {total} rows in {duration:.3f} seconds ({total / duration:.0f} rows/s)")
+
+    def _flush_streaming(self, table_name):
+        """
+        Insert the buffered rows using streaming inserts, with at most BATCH_SIZE rows and BATCH_MAX_SIZE bytes per
+        request. Rows that failed are kept in the buffer with their insert ID, such that a retry does not insert
+        duplicates. Invalid rows are removed from the buffer.
+
+        :param str table_name: the name of the table, including the dataset
+        """
+
+        try:
+            table = self._get_table(table_name, columns=set().union(*[row.keys() for row, _, _ in self.buffer]))
+        except NotFound:
+            self._invalidate_table(table_name)
+            raise ConnectorError(f"Table {table_name} was not found")
+        except GoogleAPIError as e:
+            raise RecoverableConnectorError(f"Failed to get table {table_name}: {e}")
+
+        failed = []
+        invalid = []
+        error = None
+        invalid_error = None
+
+        for batch in self._split_batches(self.buffer):
+            try:
+                errors = self.client.insert_rows(
+                    table=table, rows=[row for row, _, _ in batch], row_ids=[row_id for _, row_id, _ in batch]
+                )
+            except (ValueError, TypeError) as e:
+                invalid.extend(batch)
+                invalid_error = e
+                continue
+            except GoogleAPIError as e:
+                failed.extend(batch)
+                error = e
+                continue
+
+            for row_errors in errors:
+                # Rows that are invalid cannot be inserted, other rows of the request are not inserted either and
+                # have the reason 'stopped'
+                reasons = {row_error.get('reason') for row_error in row_errors['errors']}
+                if 'invalid' in reasons:
+                    invalid.append(batch[row_errors['index']])
+                    invalid_error = row_errors['errors'][0]['message']
+                else:
+                    failed.append(batch[row_errors['index']])
+                    error = row_errors['errors'][0]['message']
+
+        total = len(self.buffer)
+        self.buffer = failed
+        self.buffer_bytes = sum(size for _, _, size in failed)
+
+        if invalid:
+            # Invalid rows may be caused by a change of the schema, so fetch the table again for the next insert
+            self._invalidate_table(table_name)
+            logger.error(f"Discarded {len(invalid)} invalid rows: {invalid_error}")
+
+        if failed:
+            raise RecoverableConnectorError(f"Failed to insert {len(failed)} of {total} rows: {error}")
+        if invalid:
+            self.buffer_started = None
+            raise ConnectorError(f"Failed to insert {len(invalid)} of {total} rows: {invalid_error}")
+
+    def _split_batches(self, rows):
+        """
+        Split the given rows in batches of at most BATCH_SIZE rows and BATCH_MAX_SIZE bytes
+
+        :param list rows: a list of (row, insert ID, size) tuples
+        :return list: a list of batches, each a list of rows
+        """
+
+        batches = []
+        batch = []
+        batch_bytes = 0
+
+        for row in rows:
+            if batch and (len(batch) >= max(self.batch_size, 1) or batch_bytes + row[2] > self.batch_max_size):
+                batches.append(batch)
+                batch = []
+                batch_bytes = 0
+
+            batch.append(row)
+            batch_bytes += row[2]
+
+        if batch:
+            batches.append(batch)
+
+        return batches
+
+    def _flush_load(self, table_name):
+        """
+        Load the spool file into the table with a load job. A pending file of a previous attempt is loaded first.
+
+        :param str table_name: the name of the table, including the dataset
+        """
+
+        while self.pending_spool is not None or self.spool_rows:
+            if self.pending_spool is None:
+                # Rows that are added while the load job is retried are written to a new spool file, such that they
+                # are not discarded when the load job of the pending file succeeds
+                self.pending_spool = self.spool
+                self.pending_rows = self.spool_rows
+                self.pending_job_id = None
+                self.pending_job_location = None
+                self.spool = None
+                self.spool_rows = 0
+                self.buffer_bytes = 0
+                self.buffer_started = None
+
+            self._load_pending(table_name)
+
+    def _load_pending(self, table_name):
+        """
+        Load the pending file into the table with a load job. The load job has a fixed ID for each pending file, such
+        that a retry waits for the job of a previous attempt instead of loading the rows again.
+
+        :param str table_name: the name of the table, including the dataset
+        """
+
+        try:
+            table = self._get_table(table_name)
+
+            job = None
+            if self.pending_job_id is not None:
+                # The job of a previous attempt may still succeed. If it failed, the file is loaded by a new job.
+                try:
+                    job = self.client.get_job(self.pending_job_id, location=self.pending_job_location)
+                    if job.state == 'DONE' and job.error_result:
+                        job = None
+                except NotFound:
+                    job = None
+
+            if job is None:
+                # Jobs outside the US and EU multi-regions are only found when their location is given, so the job
+                # is run in the location of the table and the location is kept with the job ID
+                self.pending_job_id = f"ubiops_load_{uuid.uuid4().hex}"
+                self.pending_job_location = table.location
+                job_config = bigquery.LoadJobConfig()
+                job_config.source_format = bigquery.SourceFormat.NEWLINE_DELIMITED_JSON
+                job_config.write_disposition = bigquery.WriteDisposition.WRITE_APPEND
+                job = self.client.load_table_from_file(
+                    self.pending_spool, table, rewind=True, job_id=self.pending_job_id,
+                    location=self.pending_job_location, job_config=job_config
+                )
+
+            job.result(timeout=self.load_timeout)
+
+        except BadRequest as e:
+            # The rows in the file are invalid, so loading the file again would fail as well
+            rows = self.pending_rows
+            self._invalidate_table(table_name)
+            self._remove_pending()
+            raise ConnectorError(f"Failed to load {rows} rows: {e}")
+
+        except NotFound:
+            self._invalidate_table(table_name)
+            raise ConnectorError(f"Table {table_name} was not found")
+
+        except (GoogleAPIError, requests.exceptions.RequestException, concurrent.futures.TimeoutError) as e:
+            raise RecoverableConnectorError(f"Failed to load rows: {e}")
+
+        self._remove_pending()
+
+    def _remove_pending(self):
+        """
+        Remove the pending file
+        """
+
+        if self.pending_spool is not None:
+            self.pending_spool.close()
+
+        self.pending_spool = None
+        self.pending_rows = 0
+        self.pending_job_id = None
+        self.pending_job_location = None
+
+    def _get_table(self, table_name, columns=()):
+        """
+        Get the metadata of a table. The metadata is cached for TABLE_CACHE_TTL seconds. As the client drops columns
+        that are missing from the schema of the table, the metadata is fetched again when the given columns are not in
+        the cached schema. Columns that are still missing afterwards do not cause the metadata to be fetched again
+        until it expires.
+
+        :param str table_name: the name of the table, including the dataset
+        :param columns: the names of the columns that will be inserted
+        :return bigquery.Table: the table
+        """
+
+        with self.tables_lock:
+            cached = self.tables.get(table_name)
+
+        missing = set()
+        if cached is not None and time.monotonic() - cached['fetched'] < self.table_cache_ttl:
+            if set(columns) <= cached['columns'] | cached['missing']:
+                return cached['table']
+            missing = cached['missing']
+
+        table = self.client.get_table(table_name)
+        table_columns = {field.name for field in table.schema}
+
+        with self.tables_lock:
+            self.tables[table_name] = {
+                'table': table,
+                'fetched': time.monotonic(),
+                'columns': table_columns,
+                'missing': missing | (set(columns) - table_columns)
+            }
+
+        return table
+
+    def _invalidate_table(self, table_name):
+        """
+        Remove the metadata of a table from the cache
+
+        :param str table_name: the name of the table, including the dataset
+        """
+
+        with self.tables_lock:
+            self.tables.pop(table_name, None)
+
     def stop(self):
         """
-        Close connection to BigQuery by closing the credentials file descriptor
+        Insert the remaining buffered rows, and close connection to BigQuery by closing the credentials file descriptor
         """
 
+        with self.buffer_lock:
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+
+        try:
+            self.flush()
+        except ConnectorError as e:
+            logger.error(f"Failed to insert buffered rows on stop: {e}")
+
+        for spool in (self.spool, self.pending_spool):
+            if spool is not None:
+                spool.close()
+
         self.key_file.close()
@@ -1,7 +1,15 @@
+import concurrent.futures
+import hashlib
+import io
 import json
 import logging
+import math
+import mimetypes
 import os
+import requests
 import tempfile
+import time
+import uuid
 
 from google.cloud import storage, exceptions
 
@@ -11,6 +19,142 @@ logger = logging.getLogger('Google Cloud Storage Connector')
 
 DEFAULT_MULTIPART_CHUNK_SIZE = 10 * 1024 * 1024  # 10 MB
 
+MB = 1024 * 1024
+
+# Maximum number of source objects of a single compose request
+MAX_COMPOSE_SOURCES = 32
+
+# Files larger than this size are uploaded in chunks using a resumable upload session
+MAX_SINGLE_UPLOAD_SIZE = 8 * MB
+
+# The chunks of a resumable upload must be a multiple of 256 KB. The chunk size is adapted such that uploading a chunk
+# takes about the target duration.
+CHUNK_SIZE_MULTIPLE = 256 * 1024
+MIN_CHUNK_SIZE = 4 * CHUNK_SIZE_MULTIPLE
+MAX_CHUNK_SIZE = 64 * MB
+CHUNK_TARGET_DURATION = 5
+
+# Resumable upload sessions expire after a week
+MAX_SESSION_AGE = 6 * 24 * 60 * 60
+
+# Timeout in seconds of the requests to a resumable upload session
+SESSION_TIMEOUT = (10, 120)
+
+
+class BytesReader(io.RawIOBase):
+    """
+    Seekable file object that reads from a bytes-like object without copying it
+    """
+
+    def __init__(self, data):
+        """
+        :param bytes|bytearray|memoryview data: the data to read
+        """
+
+        super().__init__()
+        self.view = memoryview(data).cast('B')
+        self.position = 0
+
+    def __len__(self):
+        return len(self.view)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = max(min(len(buffer), len(self.view) - self.position), 0)
+        buffer[:size] = self.view[self.position:self.position + size]
+        self.position += size
+        return size
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+
+        self.position = offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+
+class StreamSlice(io.RawIOBase):
+    """
+    File object that reads a slice of a stream. The position of the slice starts at 0, since the resumable uploads of
+    the client library require a stream at position 0 that reports its position, also when the stream itself is not
+    seekable.
+    """
+
+    def __init__(self, stream, offset=None, length=None):
+        """
+        :param io.IOBase stream: the stream to read from
+        :param int|None offset: the position in the stream where the slice starts, or None to start at the current
+            position of the stream
+        :param int|None length: the number of bytes in the slice, or None to read until the end of the stream
+        """
+
+        super().__init__()
+        self.stream = stream
+        self.offset = stream.tell() if offset is None and stream.seekable() else offset
+        self.length = length
+        self.position = 0
+
+        if self.offset is not None:
+            self.stream.seek(self.offset)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return self.offset is not None
+
+    def readinto(self, buffer):
+        size = len(buffer)
+        if self.length is not None:
+            size = max(min(size, self.length - self.position), 0)
+
+        # A stream may return fewer bytes than requested before its end, while a short chunk ends a resumable upload
+        read = 0
+        while read < size:
+            data = self.stream.read(size - read)
+            if not data:
+                break
+            buffer[read:read + len(data)] = data
+            read += len(data)
+
+        self.position += read
+        return read
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            if self.length is None:
+                raise io.UnsupportedOperation("Cannot seek from the end of a slice of unknown length")
+            offset += self.length
+
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+
+        if offset != self.position:
+            if self.offset is None:
+                raise io.UnsupportedOperation("Stream is not seekable")
+            self.stream.seek(self.offset + offset)
+            self.position = offset
+
+        return self.position
+
+    def tell(self):
+        return self.position
+
 
 class Deployment(OutputConnector):
 
@@ -25,11 +169,25 @@ class Deployment(OutputConnector):
         # Set the chunk size for uploads
         self.chunk_size = DEFAULT_MULTIPART_CHUNK_SIZE
 
+        # Files larger than the composite threshold are uploaded in parallel as multiple temporary objects, which are
+        # composed into the destination object
+        self.composite_threshold = int(float(get_variable('COMPOSITE_THRESHOLD', '150')) * MB)
+        self.composite_parts = min(int(get_variable('COMPOSITE_PARTS', '8')), MAX_COMPOSE_SOURCES)
+
         # Write credentials string to a temporary file
         self.key_file = tempfile.NamedTemporaryFile()
 
-        # Setup the client
+        # Setup the client and the bucket, which are used for the lifetime of the deployment
         self.client = self.setup()
+        self.bucket = self.client.bucket(bucket_name=get_variable('BUCKET'))
+
+        # The URIs of resumable upload sessions are stored in the session directory until the upload completes, such
+        # that a retried upload continues from the last chunk that was stored by GCS
+        self.session_directory = get_variable(
+            'SESSION_DIRECTORY', os.path.join(tempfile.gettempdir(), 'gcs-upload-sessions')
+        )
+        os.makedirs(self.session_directory, exist_ok=True)
+        self.session = requests.Session()
 
     def setup(self):
         """
@@ -45,10 +203,10 @@ class Deployment(OutputConnector):
         except (json.decoder.JSONDecodeError, TypeError, ValueError) as e:
             raise ConnectorError(f"Failed to initialise GCS client: {e}")
 
-    @retry(attempts=3)
     def insert(self, data):
         """
-        Insert given data to GCS
+        Insert given data to GCS. The field 'blob' contains a file path, bytes or a file-like object. Bytes and file
+        objects are uploaded without writing them to disk.
 
         :param dict data: a dictionary containing the data to be inserted
         """
@@ -57,28 +215,307 @@ class Deployment(OutputConnector):
         if 'blob' not in data:
             raise ConnectorError("Field 'blob' is not given in the input")
 
-        file_path = data['blob']
-        filename = os.path.basename(file_path)
+        if isinstance(data['blob'], (bytes, bytearray, memoryview)) or hasattr(data['blob'], 'read'):
+            file_obj = data['blob'] if hasattr(data['blob'], 'read') else BytesReader(data['blob'])
+            filename = data.get('filename') or getattr(file_obj, 'name', None)
+            if not isinstance(filename, str) or not filename:
+                raise ConnectorError("Field 'filename' is required when the blob is not a file path")
+
+            # A seekable stream is rewound to its current position when the upload is retried
+            position = file_obj.tell() if file_obj.seekable() else None
+            self.upload(file_obj, os.path.basename(filename), position)
+            return
+
+        self.upload(data['blob'], os.path.basename(data['blob']))
+
+    @retry(attempts=3)
+    def upload(self, source, filename, position=None):
+        """
+        Upload a file or file object to GCS. Large files are uploaded in chunks using a resumable upload session, or
+        in parallel as composite object. File objects are uploaded in chunks of the chunk size if they are larger than
+        the chunk size.
+
+        :param str|io.IOBase source: the path of the file or the file object to upload
+        :param str filename: the filename of the blob
+        :param int|None position: the position in the file object to upload from, or None if it is not seekable
+        """
 
-        bucket = get_variable('BUCKET')
         path_prefix = get_variable('PATH_PREFIX', '')
 
         # Generate the destination blob name by concatenating (optional) path prefix and filename
         object_path = os.path.join(path_prefix, filename)
 
         try:
-            bucket = self.client.bucket(bucket_name=bucket)
-            blob = bucket.blob(object_path, chunk_size=self.chunk_size)
-            blob.upload_from_filename(filename=file_path)
+            blob = self.bucket.blob(object_path, chunk_size=self.chunk_size)
+
+            if isinstance(source, str):
+                size = os.path.getsize(source)
+                if self.composite_parts > 1 and size >= self.composite_threshold:
+                    self._upload_composite(blob, source)
+                elif size > MAX_SINGLE_UPLOAD_SIZE:
+                    self._upload_resumable(blob, source)
+                else:
+                    blob.upload_from_filename(filename=source)
+            else:
+                size = None
+                if position is not None:
+                    size = source.seek(0, io.SEEK_END) - position
+                blob.upload_from_file(file_obj=StreamSlice(source, position, size), size=size)
 
         except exceptions.GoogleCloudError as e:
+            # A stream that is not seekable cannot be uploaded again
+            if not isinstance(source, str) and position is None:
+                raise ConnectorError(f"Failed to insert blob: {e}")
             raise RecoverableConnectorError(f"Failed to insert blob: {e}")
 
+        except ValueError as e:
+            # Raised by the client library for a stream that cannot be uploaded
+            raise ConnectorError(f"Failed to insert blob: {e}")
+
         logger.info("Blob inserted successfully")
 
+    def _upload_composite(self, blob, file_path):
+        """
+        Upload a file as a composite object. The file is split in slices, which are uploaded concurrently as temporary
+        objects and then composed into the destination blob. The temporary objects are always deleted afterwards.
+
+        :param storage.Blob blob: the destination blob
+        :param str file_path: the path of the file to upload
+        """
+
+        size = os.path.getsize(file_path)
+        slice_size = math.ceil(size / self.composite_parts)
+        slices = [(offset, min(slice_size, size - offset)) for offset in range(0, size, slice_size)]
+
+        # The temporary objects get a unique name, such that concurrent uploads to the same blob do not interfere
+        token = uuid.uuid4().hex
+        parts = [
+            self.bucket.blob(f"{blob.name}.{token}.part{index}", chunk_size=self.chunk_size)
+            for index in range(len(slices))
+        ]
+
+        def upload_slice(part, offset, length):
+            with open(file_path, 'rb') as file:
+                part.upload_from_file(file_obj=StreamSlice(file, offset, length), size=length)
+
+        started = time.monotonic()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(parts)) as executor:
+                futures = [
+                    executor.submit(upload_slice, part, offset, length)
+                    for part, (offset, length) in zip(parts, slices)
+                ]
+                for future in futures:
+                    future.result()
+
+            # Compose does not guess the content type, so it is guessed from the filename like upload_from_filename does
+            content_type = mimetypes.guess_type(file_path)[0]
+            if blob.content_type is None and content_type is not None:
+                blob.content_type = content_type
+            blob.compose(parts)
+
+        finally:
+            self._delete_parts(parts)
+
+        duration = max(time.monotonic() - started, 1e-6)
+        logger.info(f"Uploaded {size / MB:.1f} MB in {len(parts)} parts in {duration:.3f} seconds "
+                    f"({size / MB / duration:.1f} MB/s)")
+
+    def _upload_resumable(self, blob, file_path):
+        """
+        Upload a file in chunks using a resumable upload session. If the upload of the file was interrupted before, it
+        continues from the last chunk that was stored by GCS.
+
+        :param storage.Blob blob: the destination blob
+        :param str file_path: the path of the file to upload
+        """
+
+        size = os.path.getsize(file_path)
+        session_file = self._get_session_file(blob.name, file_path)
+
+        session_uri = self._load_session(session_file)
+        offset = 0
+        if session_uri is not None:
+            offset = self._put_chunk(session_uri, session_file, b'', 0, size)
+            logger.info(f"Resuming upload of {blob.name} at {offset / MB:.1f} of {size / MB:.1f} MB")
+        else:
+            # The content type is guessed from the filename, like upload_from_filename does
+            session_uri = blob.create_resumable_upload_session(
+                content_type=mimetypes.guess_type(file_path)[0], size=size
+            )
+            self._save_session(session_file, session_uri)
+
+        started = time.monotonic()
+        resumed_offset = offset
+
+        with open(file_path, 'rb') as file:
+            while offset < size:
+                file.seek(offset)
+                chunk = file.read(self.chunk_size)
+
+                chunk_started = time.monotonic()
+                committed = self._put_chunk(session_uri, session_file, chunk, offset, size)
+                self._adapt_chunk_size(committed - offset, time.monotonic() - chunk_started)
+
+                # GCS may store only a part of the chunk, in which case the remainder is sent again
+                offset = committed
+
+        self._remove_session(session_file)
+
+        duration = max(time.monotonic() - started, 1e-6)
+        logger.info(f"Uploaded {(size - resumed_offset) / MB:.1f} MB in {duration:.3f} seconds "
+                    f"({(size - resumed_offset) / MB / duration:.1f} MB/s)")
+
+    def _put_chunk(self, session_uri, session_file, chunk, offset, size):
+        """
+        Send a chunk to a resumable upload session. Sending an empty chunk queries the status of the session.
+
+        :param str session_uri: the URI of the resumable upload session
+        :param str session_file: the file in which the session is stored
+        :param bytes chunk: the chunk to send
+        :param int offset: the offset of the chunk in the file
+        :param int size: the size of the file
+        :return int: the number of bytes stored by GCS
+        """
+
+        content_range = f"bytes {offset}-{offset + len(chunk) - 1}/{size}" if chunk else f"bytes */{size}"
+
+        try:
+            response = self.session.put(
+                session_uri, data=chunk, headers={'Content-Range': content_range}, timeout=SESSION_TIMEOUT
+            )
+        except requests.RequestException as e:
+            raise RecoverableConnectorError(f"Failed to upload chunk: {e}")
+
+        if response.status_code in (200, 201):
+            return size
+
+        if response.status_code == 308:
+            # The range header contains the bytes that were stored, for example 'bytes=0-262143'
+            stored_range = response.headers.get('Range')
+            return int(stored_range.split('-')[-1]) + 1 if stored_range else 0
+
+        if response.status_code in (404, 410):
+            # The session expired, so the upload has to start over with a new session
+            self._remove_session(session_file)
+            raise RecoverableConnectorError(f"Resumable upload session expired: {response.text}")
+
+        if response.status_code == 429 or response.status_code >= 500:
+            raise RecoverableConnectorError(f"Failed to upload chunk: {response.status_code} {response.text}")
+
+        self._remove_session(session_file)
+        raise ConnectorError(f"Failed to upload chunk: {response.status_code} {response.text}")
+
+    def _adapt_chunk_size(self, chunk_size, duration):
+        """
+        Adapt the chunk size to the observed throughput, such that uploading a chunk takes about the target duration.
+        Larger chunks reduce the overhead of the requests, while smaller chunks limit the data that is sent again when
+        an upload is interrupted.
+
+        :param int chunk_size: the number of bytes that were uploaded
+        :param float duration: the duration of the upload in seconds
+        """
+
+        if chunk_size <= 0 or duration <= 0:
+            return
+
+        target = (self.chunk_size + chunk_size / duration * CHUNK_TARGET_DURATION) / 2
+        target = int(target) // CHUNK_SIZE_MULTIPLE * CHUNK_SIZE_MULTIPLE
+        self.chunk_size = max(MIN_CHUNK_SIZE, min(target, MAX_CHUNK_SIZE))
+
+    def _get_session_file(self, object_path, file_path):
+        """
+        Get the path of the file in which the resumable upload session of a file is stored. The session is only reused
+        for the same file, destination and file modification time.
+
+        :param str object_path: the name of the destination blob
+        :param str file_path: the path of the file to upload
+        :return str: the path of the session file
+        """
+
+        stat = os.stat(file_path)
+        key = f"{self.bucket.name}/{object_path}:{os.path.abspath(file_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+        return os.path.join(self.session_directory, f"{hashlib.sha256(key.encode('utf-8')).hexdigest()}.json")
+
+    @staticmethod
+    def _load_session(session_file):
+        """
+        Load a resumable upload session
+
+        :param str session_file: the file in which the session is stored
+        :return str|None: the URI of the session, or None if there is no session or it expired
+        """
+
+        try:
+            with open(session_file) as file:
+                session = json.load(file)
+        except (OSError, ValueError):
+            return None
+
+        if time.time() - session.get('created', 0) > MAX_SESSION_AGE:
+            return None
+
+        return session.get('session_uri')
+
+    @staticmethod
+    def _save_session(session_file, session_uri):
+        """
+        Store a resumable upload session
+
+        :param str session_file: the file in which the session is stored
+        :param str session_uri: the URI of the session
+        """
+
+        try:
+            with open(session_file, 'w') as file:
+                json.dump({'session_uri': session_uri, 'created': time.time()}, file)
+        except OSError as e:
+            logger.warning(f"Failed to store resumable upload session: {e}")
+
+    @staticmethod
+    def _remove_session(session_file):
+        """
+        Remove a stored resumable upload session
+
+        :param str session_file: the file in which the session is stored
+        """
+
+        try:
+            os.remove(session_file)
+        except OSError:
+            pass
+
+    def _delete_parts(self, parts):
+        """
+        Delete the temporary objects of a composite upload in a single batch request. Objects that do not exist, because
+        their upload failed, are ignored.
+
+        :param list parts: the temporary blobs
+        """
+
+        try:
+            with self.client.batch():
+                for part in parts:
+                    part.delete()
+
+        except exceptions.NotFound:
+            # The batch raises for the first part that was not found, so delete the others one by one
+            for part in parts:
+                try:
+                    part.delete()
+                except exceptions.NotFound:
+                    pass
+                except exceptions.GoogleCloudError as e:
+                    logger.warning(f"Failed to delete temporary object {part.name}: {e}")
+
+        except exceptions.GoogleCloudError as e:
+            logger.warning(f"Failed to delete temporary objects: {e}")
+
     def stop(self):
         """
-        Close connection to GCS by closing the credentials file descriptor
+        Close connection to GCS by closing the credentials file descriptor and the HTTP session
         """
 
+        self.session.close()
         self.key_file.close()
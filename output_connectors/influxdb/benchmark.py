@@ -0,0 +1,57 @@
+import argparse
+import timeit
+
+import influxdb_client
+
+from deployment import Deployment, LineProtocolEncoder
+
+
+EXAMPLE_DATA = {
+    'measurement': 'example-measurement',
+    'fields': "value1=1, value2=1.5, value3=example-field",
+    'tags': "tag1=1, tag2=example-tag",
+    'time': 1577836800000000000
+}
+
+
+def encode_point(data):
+    """
+    Encode the request data to line protocol using the `Point` class of the client library
+
+    :param dict data: a dictionary containing the data to be inserted
+    :return str: the point in line protocol
+    """
+
+    point_values = {
+        'measurement': data['measurement'],
+        'tags': Deployment._extract_elements(elements_csv=data['tags']),
+        'fields': Deployment._extract_elements(elements_csv=data['fields'], elements_type='fields'),
+        'time': data['time']
+    }
+
+    return influxdb_client.Point.from_dict(dictionary=point_values).to_line_protocol()
+
+
+def main():
+    """
+    Compare the time it takes to encode a point using the `Point` class and using the line protocol encoder
+    """
+
+    parser = argparse.ArgumentParser(description="Benchmark encoding request data to InfluxDB line protocol")
+    parser.add_argument('--number', type=int, default=100000, help="number of points to encode")
+    args = parser.parse_args()
+
+    encoder = LineProtocolEncoder()
+
+    print(f"Point:   {encode_point(EXAMPLE_DATA)}")
+    print(f"Encoder: {encoder.encode(EXAMPLE_DATA).decode('utf-8')}")
+
+    point_time = timeit.timeit(lambda: encode_point(EXAMPLE_DATA), number=args.number)
+    encoder_time = timeit.timeit(lambda: encoder.encode(EXAMPLE_DATA), number=args.number)
+
+    print(f"Point:   {args.number / point_time:,.0f} points/s")
+    print(f"Encoder: {args.number / encoder_time:,.0f} points/s ({point_time / encoder_time:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,176 @@
 import dateutil
+import functools
 import logging
 import influxdb_client
 import influxdb_client.rest
 import json
+import math
 import urllib3
 
 from influxdb_client import WritePrecision
-from influxdb_client.client.write_api import SYNCHRONOUS
+from influxdb_client.client.write_api import SYNCHRONOUS, WriteOptions, WriteType
 
 from ubiops_connector import OutputConnector, ConnectorError, RecoverableConnectorError, get_variable, retry
 
 
 logger = logging.getLogger('InfluxDB Connector')
 
+# Digit strings up to this length can be dates without separators, such as 20220101 or 20220101123000, which the
+# client library parses as dates instead of Unix timestamps
+MAX_DATE_DIGITS = 14
+
+# Characters that a JSON value can start with, including NaN and Infinity which the json module accepts. Values that
+# start with any other character are strings, which are not parsed to avoid the cost of the parsing error.
+JSON_START = frozenset('"-0123456789tfnNI[{')
+
+# Characters that must be escaped in the different elements of line protocol
+ESCAPE_MEASUREMENT = str.maketrans({',': r'\,', ' ': r'\ ', '\n': r'\n', '\t': r'\t', '\r': r'\r'})
+ESCAPE_KEY = str.maketrans({',': r'\,', '=': r'\=', ' ': r'\ ', '\n': r'\n', '\t': r'\t', '\r': r'\r'})
+ESCAPE_STRING = str.maketrans({'"': r'\"', '\\': r'\\'})
+
+
+class LineProtocolEncoder:
+    """
+    Encoder that converts the request input fields directly to InfluxDB line protocol
+    """
+
+    def __init__(self, tag_cache_size=1024):
+        """
+        :param int tag_cache_size: number of encoded tag sets to cache
+        """
+
+        # The same tag sets are typically used for many points, so the encoded tag sets are cached
+        self.encode_tags = functools.lru_cache(maxsize=tag_cache_size)(self._encode_tags)
+
+    def encode(self, data):
+        """
+        Encode the point described by the request data to line protocol. Points with a time that is not a Unix
+        timestamp cannot be encoded directly, including digit strings that may be dates.
+
+        :param dict data: a dictionary containing the data to be inserted
+        :return bytes|None: the point in line protocol, or None if the time is not a Unix timestamp
+        """
+
+        timestamp = ''
+        if 'time' in data and data['time'] is not None:
+            timestamp = data['time']
+            if isinstance(timestamp, str):
+                digits = timestamp.strip().lstrip('-')
+                if not digits.isdigit() or len(digits) <= MAX_DATE_DIGITS:
+                    return None
+            elif not isinstance(timestamp, int) or isinstance(timestamp, bool):
+                return None
+            timestamp = f" {int(timestamp)}"
+
+        tags = self.encode_tags(data['tags']) if 'tags' in data and data['tags'] else ''
+
+        fields = self._encode_fields(data['fields'])
+        if not fields:
+            raise ConnectorError("Request input field named 'fields' must contain at least one element")
+
+        return f"{str(data['measurement']).translate(ESCAPE_MEASUREMENT)}{tags} {fields}{timestamp}".encode('utf-8')
+
+    @staticmethod
+    def _split(elements_csv, elements_type):
+        """
+        Split a string containing key-value pairs separated by commas into a dictionary. Values are parsed as JSON,
+        values that are not valid JSON are kept as they are.
+
+        :param str elements_csv: string containing key-value pairs of either tags or fields
+        :param str elements_type: type of element that is being split, for error messages
+        :return dict: dictionary containing the key-value pairs
+        """
+
+        elements = {}
+        try:
+            for element in elements_csv.split(','):
+                key, value = element.split('=')
+                if value.strip()[:1] in JSON_START:
+                    try:
+                        value = json.loads(value.strip())
+                    except json.decoder.JSONDecodeError:
+                        pass
+                elements[key.strip()] = value
+
+        except ValueError:
+            raise ConnectorError(f"Structure of the '{elements_type}' request input field is wrongly formatted")
+
+        return elements
+
+    def _encode_tags(self, tags_csv):
+        """
+        Encode a string containing key-value pairs of tags to the tag set of a line, sorted by key. Values are parsed
+        as JSON and written the way the client library writes them, such that a tag ends up in the same series. Tags
+        with a null value are skipped.
+
+        :param str tags_csv: string containing key-value pairs of tags
+        :return str: the encoded tag set, including the leading comma
+        """
+
+        tags = []
+        for key, value in sorted(self._split(tags_csv, 'tags').items()):
+            if value is None:
+                continue
+
+            key = key.translate(ESCAPE_KEY)
+            value = str(value).translate(ESCAPE_KEY)
+
+            # A trailing backslash would escape the separator after the tag value
+            if value.endswith('\\'):
+                value += ' '
+
+            if key and value:
+                tags.append(f",{key}={value}")
+
+        return "".join(tags)
+
+    def _encode_fields(self, fields_csv):
+        """
+        Encode a string containing key-value pairs of fields to the field set of a line, sorted by key. Values are
+        parsed as JSON and typed the way the client library types them.
+
+        :param str fields_csv: string containing key-value pairs of fields
+        :return str: the encoded field set
+        """
+
+        fields = []
+        for key, value in sorted(self._split(fields_csv, 'fields').items()):
+            value = self._encode_field_value(key, value)
+            if value is not None:
+                fields.append(f"{key.translate(ESCAPE_KEY)}={value}")
+
+        return ",".join(fields)
+
+    @staticmethod
+    def _encode_field_value(key, value):
+        """
+        Encode a single field value. Integers, floats and booleans are written as such, strings as strings.
+
+        :param str key: the field key, for error messages
+        :param value: the field value parsed from the request data
+        :return str|None: the encoded value, or None if the field must be skipped
+        """
+
+        if value is None:
+            return None
+        if isinstance(value, bool):
+            return 'true' if value else 'false'
+        if isinstance(value, int):
+            return f"{value}i"
+
+        if isinstance(value, float):
+            if not math.isfinite(value):
+                return None
+
+            # Whole numbers are written without the trailing '.0', similar to the client library
+            number = str(value)
+            return number[:-2] if number.endswith('.0') else number
+
+        if isinstance(value, str):
+            return f'"{value.translate(ESCAPE_STRING)}"'
+
+        raise ConnectorError(f"Type {type(value).__name__} of field {key} is not supported")
+
 
 class Deployment(OutputConnector):
     """
@@ -27,9 +185,17 @@ class Deployment(OutputConnector):
 
         OutputConnector.__init__(self, base_directory, context)
 
-        # Initialize a connection object. It will be set by the connect method.
+        # Initialize a client and connection object. They will be set by the connect method.
+        self.client = None
         self.connection = None
 
+        # In batching mode, points are written in the background by the write API of the client. Errors of batches
+        # that could not be written are collected, such that they can be raised when the deployment is stopped.
+        self.batching = get_variable('WRITE_MODE', 'synchronous').lower() == 'batching'
+        self.write_errors = []
+
+        self.encoder = LineProtocolEncoder(tag_cache_size=int(get_variable('TAG_CACHE_SIZE', '1024')))
+
     def connect(self):
         """
         Connect to InfluxDB server database
@@ -40,16 +206,46 @@ class Deployment(OutputConnector):
         self.connection = None
 
         try:
-            self.connection = influxdb_client.InfluxDBClient(
+            self.client = influxdb_client.InfluxDBClient(
                 url=get_variable('URL'),
                 token=get_variable('TOKEN'),
                 org=get_variable('ORGANIZATION'),
+                enable_gzip=get_variable('GZIP', 'false').lower() == 'true',
                 debug=False
-            ).write_api(write_options=SYNCHRONOUS)
+            )
+
+            if self.batching:
+                self.connection = self.client.write_api(
+                    write_options=WriteOptions(
+                        write_type=WriteType.batching,
+                        batch_size=int(get_variable('BATCH_SIZE', '1000')),
+                        flush_interval=int(get_variable('FLUSH_INTERVAL', '1000')),
+                        jitter_interval=int(get_variable('JITTER_INTERVAL', '0')),
+                        retry_interval=int(get_variable('RETRY_INTERVAL', '5000')),
+                        max_retries=int(get_variable('MAX_RETRIES', '5'))
+                    ),
+                    error_callback=self._on_write_error
+                )
+            else:
+                self.connection = self.client.write_api(write_options=SYNCHRONOUS)
 
         except urllib3.exceptions.HTTPError as e:
             raise RecoverableConnectorError(f"Failed to connect to database: {e}")
 
+    def _on_write_error(self, configuration, data, exception):
+        """
+        Callback of the write API for batches that could not be written, after all retries have failed
+
+        :param tuple configuration: the bucket, organization and write precision of the batch
+        :param str|bytes data: the batch of points in line protocol
+        :param Exception exception: the error that occurred when writing the batch
+        """
+
+        lines = data.count(b'\n' if isinstance(data, bytes) else '\n') + 1
+        logger.error(f"Failed to write batch of {lines} points to bucket {configuration[0]}: {exception}")
+
+        self.write_errors.append(exception)
+
     @staticmethod
     def _extract_elements(elements_csv, elements_type='tags'):
         """
@@ -61,19 +257,7 @@ class Deployment(OutputConnector):
         :return: dictionary containing the key-value pairs of tags or fields
         """
 
-        elements = {}
-        try:
-            for element in elements_csv.split(','):
-                key, value = element.split('=')
-                try:
-                    elements[key.strip()] = json.loads(value.strip())
-                except json.decoder.JSONDecodeError:
-                    elements[key.strip()] = value
-
-        except ValueError:
-            raise ConnectorError(f"Structure of the '{elements_type}' request input field is wrongly formatted")
-
-        return elements
+        return LineProtocolEncoder._split(elements_csv, elements_type)
 
     @staticmethod
     def _match_write_precision(data):
@@ -98,18 +282,14 @@ class Deployment(OutputConnector):
         # Default Write Precision to NS
         return WritePrecision.NS
 
-    @retry(attempts=3)
-    def insert(self, data):
+    def _to_point(self, data):
         """
-        Insert given data to InfluxDB bucket. If the insert fails due to lost database connection, retry inserting.
+        Convert the request data to a `Point` object
 
         :param dict data: a dictionary containing the data to be inserted
+        :return: `Point` object containing the data to be inserted
         """
 
-        # Including the connect in the insert method such that it can benefit from retrying
-        if not self.connection:
-            self.connect()
-
         point_values = {}
 
         if 'time' in data:
@@ -118,39 +298,75 @@ class Deployment(OutputConnector):
         if 'tags' in data and data['tags']:
             point_values['tags'] = self._extract_elements(elements_csv=data['tags'])
 
-        try:
-            point_values['measurement'] = data['measurement']
+        point_values['measurement'] = data['measurement']
 
-            fields = self._extract_elements(elements_csv=data['fields'], elements_type='fields')
-            if fields:
-                point_values['fields'] = fields
-            else:
-                raise ConnectorError("Request input field named 'fields' must contain at least one element")
+        fields = self._extract_elements(elements_csv=data['fields'], elements_type='fields')
+        if fields:
+            point_values['fields'] = fields
+        else:
+            raise ConnectorError("Request input field named 'fields' must contain at least one element")
 
-            point = influxdb_client.Point.from_dict(
-                dictionary=point_values,
-                write_precision=self._match_write_precision(data)
+        return influxdb_client.Point.from_dict(
+            dictionary=point_values,
+            write_precision=self._match_write_precision(data)
+        )
+
+    @retry(attempts=3)
+    def insert(self, data):
+        """
+        Insert given data to InfluxDB bucket. If the insert fails due to lost database connection, retry inserting.
+
+        :param dict data: a dictionary containing the data to be inserted
+        """
+
+        # Including the connect in the insert method such that it can benefit from retrying
+        if not self.connection:
+            self.connect()
+
+        try:
+            # Encode the point directly to line protocol. Only points with a time that is not a Unix timestamp are
+            # converted using the Point class of the client, which parses the time using dateutil.
+            record = self.encoder.encode(data)
+            if record is None:
+                record = self._to_point(data)
+
+            self.connection.write(
+                get_variable('BUCKET'), record=record, write_precision=self._match_write_precision(data)
             )
-            self.connection.write(get_variable('BUCKET'), record=point)
 
         except dateutil.parser._parser.ParserError:
-            self.connection = None
             raise ConnectorError(f"Failed to insert data: request input field 'time' is wrongly formatted")
 
         except KeyError as e:
-            self.connection = None
             raise ConnectorError(f"Failed to insert data: request data missing required input field named {e}")
 
         except influxdb_client.rest.ApiException as e:
             self.connection = None
             raise ConnectorError(f"Failed to insert data: {e}")
 
-        logger.info("Data inserted successfully")
+        if self.batching:
+            logger.info("Data added to batch")
+        else:
+            logger.info("Data inserted successfully")
 
     def stop(self):
         """
-        Close connection to the database if the connection has been initialised
+        Close connection to the database if the connection has been initialised. In batching mode, closing the write
+        API waits until all buffered points are written. Raise an error if any of the batches could not be written.
         """
 
-        self.connection.close()
+        logger.info(f"Tag cache statistics: {self.encoder.encode_tags.cache_info()}")
+
+        try:
+            self.connection.close()
+            self.client.close()
+        except AttributeError:
+            pass
+
+        self.client = None
         self.connection = None
+
+        if self.write_errors:
+            errors = self.write_errors
+            self.write_errors = []
+            raise ConnectorError(f"Failed to write {len(errors)} batches of data: {errors[0]}")
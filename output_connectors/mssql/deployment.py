@@ -1,4 +1,7 @@
 import logging
+import threading
+import time
+import pyodbc
 import sqlalchemy
 import sqlalchemy.exc
 
@@ -8,6 +11,10 @@ from ubiops_connector import OutputConnector, ConnectorError, RecoverableConnect
 
 logger = logging.getLogger('MSSQL Connector')
 
+# Connections are pooled by SQLAlchemy. Disable the pooling of pyodbc, such that connections that are closed or recycled
+# by SQLAlchemy are actually closed.
+pyodbc.pooling = False
+
 
 class Deployment(OutputConnector):
     """
@@ -22,76 +29,219 @@ class Deployment(OutputConnector):
 
         OutputConnector.__init__(self, base_directory, context)
 
-        # Initialize a connection object. It will be set by the connect method.
-        self.connection = None
-
-    def connect(self):
+        # Setup the engine, which manages a pool of connections to the database for the lifetime of the deployment
+        self.engine = self.setup()
+
+        # Buffered inserts are enabled when the batch size is larger than 1. Rows are then collected in the buffer
+        # and written with fast_executemany in a single transaction once the batch is full or the oldest row exceeds
+        # the maximum age.
+        self.batch_size = int(get_variable('BATCH_SIZE', '1'))
+        self.batch_max_age = float(get_variable('BATCH_MAX_AGE', '5'))
+        self.buffer = []
+        self.buffer_started = None
+        self.buffer_lock = threading.Lock()
+        self.flush_timer = None
+
+    @staticmethod
+    def setup():
         """
-        Connect to MSSQL database
+        Setup the SQLAlchemy engine. Connections are borrowed from the pool of the engine for every insert. Connections
+        are validated with a ping when they are borrowed, and recycled after a maximum lifetime.
 
-        :return: connection: a new connection object to the database
+        :return: sqlalchemy.engine.Engine engine: the engine for the MSSQL database
         """
 
-        self.connection = None
-
         username = get_variable('USERNAME')
         password = get_variable('PASSWORD')
         host = get_variable('HOST')
         port = get_variable('PORT', '1433')
         database = get_variable('DATABASE')
         timeout = get_variable('TIMEOUT', '60')
+        pool_min_size = int(get_variable('POOL_MIN_SIZE', '1'))
+        pool_max_size = int(get_variable('POOL_MAX_SIZE', '4'))
+        pool_pre_ping = get_variable('POOL_PRE_PING', 'true').lower() == 'true'
+        pool_recycle = int(get_variable('POOL_RECYCLE', '3600'))
 
+        connection_string = f"mssql+pyodbc://{username}:{password}@{host}:{port}/{database}?" \
+            "driver=ODBC Driver 17 for SQL Server"
         try:
-            connection_string = f"mssql+pyodbc://{username}:{password}@{host}:{port}/{database}?" \
-                "driver=ODBC Driver 17 for SQL Server"
             # fast_executemany speeds up the insertion up to a 100-fold 
-            self.connection = sqlalchemy.create_engine(
+            return sqlalchemy.create_engine(
                 url=connection_string,
                 fast_executemany=True,
-                connect_args={"timeout": int(timeout)}).connect()
-        except (sqlalchemy.exc.OperationalError, sqlalchemy.exc.InterfaceError) as e:
-            raise RecoverableConnectorError(f"Failed to connect to database: {e}")
+                pool_size=pool_min_size,
+                max_overflow=max(pool_max_size - pool_min_size, 0),
+                pool_timeout=int(timeout),
+                pool_pre_ping=pool_pre_ping,
+                pool_recycle=pool_recycle,
+                connect_args={"timeout": int(timeout)})
+        except (sqlalchemy.exc.ArgumentError, ValueError) as e:
+            raise ConnectorError(f"Failed to initialise database engine: {e}")
 
-    @retry(attempts=3)
     def insert(self, data):
         """
-        Insert given data to MsSQL
+        Insert given data to MsSQL. A list of rows is written as a single batch. When buffered inserts are enabled,
+        the data is added to the buffer and the buffer is flushed once it is full or too old.
 
-        :param dict data: a dictionary containing the data to be inserted
+        :param dict|list data: a dictionary containing the data to be inserted, or a list of those dictionaries
+        """
+
+        if isinstance(data, dict) and self.batch_size <= 1:
+            self.insert_row(data)
+            return
+
+        rows = data if isinstance(data, list) else [data]
+
+        with self.buffer_lock:
+            if not self.buffer:
+                self.buffer_started = time.monotonic()
+            self.buffer.extend(rows)
+
+            age = time.monotonic() - self.buffer_started
+            full = len(self.buffer) >= self.batch_size or age >= self.batch_max_age
+            self._schedule_flush(self.batch_max_age - age)
+
+        if full:
+            self.flush()
+
+    def _schedule_flush(self, delay):
+        """
+        Start a background timer that flushes the buffer once the oldest buffered row reaches the maximum age, such
+        that the rows are written when no more data arrives. Must be called while holding the buffer lock.
+
+        :param float delay: number of seconds after which the timer fires
         """
 
-        # Including the connect in the insert method such that it can benefit from retrying
-        if not self.connection:
-            self.connect()
+        if self.flush_timer is None:
+            self.flush_timer = threading.Timer(max(delay, 0), self._flush_on_timer)
+            self.flush_timer.daemon = True
+            self.flush_timer.start()
+
+    def _flush_on_timer(self):
+        """
+        Flush the buffer if its oldest row reached the maximum age. Otherwise, the buffer was flushed and refilled
+        since the timer was started, and the timer is restarted for the remaining time of the current buffer.
+        """
 
-        # Construct the insert query
-        columns = ", ".join([f"{col}" for col in data.keys()])
-        values = ", ".join([f":{col}" for col in data.keys()])
-        query = f"INSERT INTO {get_variable('SCHEMA')}.{get_variable('TABLE')} ({columns}) " \
-                f"VALUES ({values})"
+        with self.buffer_lock:
+            self.flush_timer = None
+            if not self.buffer:
+                return
+
+            remaining = self.batch_max_age - (time.monotonic() - self.buffer_started)
+            if remaining > 0:
+                self._schedule_flush(remaining)
+                return
 
         try:
-            self.connection.execute(sqlalchemy.text(query), **data)
+            self.flush()
+        except ConnectorError as e:
+            logger.error(f"Failed to write buffered rows: {e}")
+
+        # Rows that could not be written are retried once the maximum age has passed again
+        with self.buffer_lock:
+            if self.buffer:
+                self._schedule_flush(self.batch_max_age)
+
+    @retry(attempts=3)
+    def insert_row(self, data):
+        """
+        Insert a single row to MsSQL
+
+        :param dict data: a dictionary containing the data to be inserted
+        """
+
+        query = self._get_query(data.keys())
 
-        except (sqlalchemy.exc.ProgrammingError, sqlalchemy.exc.InvalidRequestError, sqlalchemy.exc.StatementError) \
-                as e:
-            self.connection = None
+        # Borrow a connection from the pool. Connections that turn out to be broken are invalidated by SQLAlchemy,
+        # such that the pool replaces them without affecting the other connections.
+        try:
+            with self.engine.connect() as connection:
+                connection.execute(sqlalchemy.text(query), **data)
+
+        except (sqlalchemy.exc.ProgrammingError, sqlalchemy.exc.InvalidRequestError, sqlalchemy.exc.StatementError,
+                sqlalchemy.exc.TimeoutError) as e:
             raise RecoverableConnectorError(f"Failed to insert data: {e}")
 
         except (sqlalchemy.exc.DatabaseError, Exception) as e:
-            self.connection = None
             raise ConnectorError(f"Failed to insert data: {e}")
 
         logger.info("Data inserted successfully")
 
+    @retry(attempts=3)
+    def flush(self):
+        """
+        Write all buffered rows to MsSQL in a single transaction, using one executemany call for each group of
+        consecutive rows with the same columns. If the flush fails due to lost database connection, retry flushing.
+        Otherwise, the buffered rows are discarded.
+        """
+
+        with self.buffer_lock:
+            if not self.buffer:
+                return
+
+            rows = self.buffer
+            started = time.monotonic()
+
+            try:
+                with self.engine.begin() as connection:
+                    group_start = 0
+                    for index in range(1, len(rows) + 1):
+                        if index < len(rows) and rows[index].keys() == rows[group_start].keys():
+                            continue
+
+                        # Passing a list of parameters makes SQLAlchemy use executemany, which sends all rows at once
+                        # because of fast_executemany
+                        group = rows[group_start:index]
+                        connection.execute(sqlalchemy.text(self._get_query(group[0].keys())), group)
+
+                        group_start = index
+
+            except (sqlalchemy.exc.OperationalError, sqlalchemy.exc.InterfaceError, sqlalchemy.exc.TimeoutError) as e:
+                raise RecoverableConnectorError(f"Failed to insert data: {e}")
+
+            except (sqlalchemy.exc.DBAPIError, Exception) as e:
+                if isinstance(e, sqlalchemy.exc.DBAPIError) and e.connection_invalidated:
+                    raise RecoverableConnectorError(f"Failed to insert data: {e}")
+
+                self.buffer = []
+                self.buffer_started = None
+                raise ConnectorError(f"Failed to insert {len(rows)} rows: {e}")
+
+            self.buffer = []
+            self.buffer_started = None
+
+        duration = max(time.monotonic() - started, 1e-6)
+        logger.info(f"Inserted {len(rows)} rows in {duration:.3f} seconds ({len(rows) / duration:.0f} rows/s)")
+
+    @staticmethod
+    def _get_query(columns):
+        """
+        Construct the query to insert a row with the given columns
+
+        :param columns: the names of the columns to insert
+        :return str: the query, with a named parameter for each column
+        """
+
+        return f"INSERT INTO {get_variable('SCHEMA')}.{get_variable('TABLE')} ({', '.join(columns)}) " \
+               f"VALUES ({', '.join([f':{col}' for col in columns])})"
+
     def stop(self):
         """
-        Close connection to the database if the connection has been initialised
+        Write the remaining buffered rows and close the connections in the pool of the engine
         """
 
+        with self.buffer_lock:
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+
         try:
-            self.connection.close()
-        except (AttributeError, sqlalchemy.exc.DatabaseError, Exception):
-            pass
+            self.flush()
+        except ConnectorError as e:
+            logger.error(f"Failed to write buffered rows on stop: {e}")
 
-        self.connection = None
+        try:
+            self.engine.dispose()
+        except (sqlalchemy.exc.DatabaseError, Exception):
+            pass
@@ -1,4 +1,11 @@
+import collections
+import datetime
+import decimal
 import logging
+import queue
+import tempfile
+import threading
+import time
 import MySQLdb
 
 from ubiops_connector import OutputConnector, ConnectorError, RecoverableConnectorError, get_variable, retry
@@ -6,6 +13,121 @@ from ubiops_connector import OutputConnector, ConnectorError, RecoverableConnect
 
 logger = logging.getLogger('MySQL Connector')
 
+# Value types that can be written with LOAD DATA without relying on the type conversion of MySQLdb
+INFILE_TYPES = (str, int, float, decimal.Decimal, datetime.date, datetime.time)
+
+# Number of bytes of max_allowed_packet to reserve for the protocol overhead of a multi-row INSERT statement
+PACKET_MARGIN = 1024
+
+# Client error codes of a connection that failed or was lost. MySQLdb raises OperationalError for these, but also for
+# errors caused by the data, such as an unknown column or an incorrect value, which cannot succeed on a retry.
+CONNECTION_ERRORS = frozenset({
+    2002,  # CR_CONNECTION_ERROR
+    2003,  # CR_CONN_HOST_ERROR
+    2006,  # CR_SERVER_GONE_ERROR
+    2013,  # CR_SERVER_LOST
+    2055,  # CR_SERVER_LOST_EXTENDED
+})
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of MySQL connections
+    """
+
+    def __init__(self, min_size, max_size, ping_interval, timeout, **connect_kwargs):
+        """
+        :param int min_size: number of connections to open when creating the pool
+        :param int max_size: maximum number of connections that can be borrowed at the same time
+        :param float ping_interval: idle time in seconds after which a connection is validated before it is borrowed
+        :param float timeout: time in seconds to wait for a connection when all connections are in use
+        :param connect_kwargs: keyword arguments passed to `MySQLdb.connect`
+        """
+
+        self.ping_interval = ping_interval
+        self.timeout = timeout
+        self.connect_kwargs = connect_kwargs
+
+        # Idle connections together with the time they were returned. The most recently used connection is reused
+        # first, such that surplus connections stay idle.
+        self.idle = queue.LifoQueue()
+        self.semaphore = threading.BoundedSemaphore(max_size)
+
+        for _ in range(min_size):
+            self.idle.put((MySQLdb.connect(**self.connect_kwargs), time.monotonic()))
+
+    def get(self):
+        """
+        Borrow a connection from the pool. Connections that have been idle for longer than the ping interval are
+        validated first, and replaced by a new connection if they are broken.
+
+        :return: a connection to the database, which must be returned using `put`
+        """
+
+        if not self.semaphore.acquire(timeout=self.timeout):
+            raise RecoverableConnectorError("Timed out waiting for a connection from the pool")
+
+        try:
+            try:
+                connection, last_used = self.idle.get_nowait()
+            except queue.Empty:
+                return MySQLdb.connect(**self.connect_kwargs)
+
+            if time.monotonic() - last_used >= self.ping_interval:
+                try:
+                    connection.ping()
+                except MySQLdb.Error as e:
+                    logger.warning(f"Replacing broken connection: {e}")
+                    self._close(connection)
+                    connection = MySQLdb.connect(**self.connect_kwargs)
+
+            return connection
+
+        except MySQLdb.Error:
+            self.semaphore.release()
+            raise
+
+    def put(self, connection, close=False):
+        """
+        Return a borrowed connection to the pool
+
+        :param connection: the connection that was borrowed using `get`
+        :param bool close: whether to close the connection instead of reusing it
+        """
+
+        if close:
+            self._close(connection)
+        else:
+            self.idle.put((connection, time.monotonic()))
+
+        self.semaphore.release()
+
+    def close(self):
+        """
+        Close all idle connections in the pool
+        """
+
+        while True:
+            try:
+                connection, _ = self.idle.get_nowait()
+            except queue.Empty:
+                break
+
+            self._close(connection)
+
+    @staticmethod
+    def _close(connection):
+        """
+        Close the given connection, ignoring errors of connections that are already broken
+
+        :param connection: the connection to close
+        """
+
+        try:
+            connection.close()
+        except MySQLdb.Error:
+            pass
+
 
 class Deployment(OutputConnector):
     """
@@ -20,74 +142,402 @@ class Deployment(OutputConnector):
 
         OutputConnector.__init__(self, base_directory, context)
 
-        # Initialize a connection object. It will be set by the connect method.
-        self.connection = None
+        # Initialize a connection pool object. It will be set by the connect method.
+        self.pool = None
+        self.pool_lock = threading.Lock()
+
+        self.table = get_variable('TABLE')
+
+        # Insert queries keyed by the tuple of column names, ordered from least to most recently used
+        self.statement_cache_size = int(get_variable('STATEMENT_CACHE_SIZE', '32'))
+        self.statements = collections.OrderedDict()
+        self.statement_lock = threading.Lock()
+        self.statement_hits = 0
+        self.statement_misses = 0
+
+        # Buffered inserts are enabled when the batch size is larger than 1. Rows are then collected in the buffer
+        # and written in a single transaction once the batch is full or the oldest row exceeds the maximum age.
+        # Batches of at least the infile threshold are loaded with LOAD DATA LOCAL INFILE, if the threshold is set.
+        self.batch_size = int(get_variable('BATCH_SIZE', '1'))
+        self.batch_max_age = float(get_variable('BATCH_MAX_AGE', '5'))
+        self.batch_infile_threshold = int(get_variable('BATCH_INFILE_THRESHOLD', '0'))
+        self.buffer = []
+        self.buffer_started = None
+        self.buffer_lock = threading.Lock()
+        self.flush_timer = None
+
+        # The maximum length of a multi-row INSERT statement, based on max_allowed_packet of the server
+        self.max_statement_length = None
 
     def connect(self):
         """
-        Connect to MySQL database
+        Create a pool of connections to the MySQL database
+        """
+
+        with self.pool_lock:
+            if self.pool:
+                return
+
+            try:
+                self.pool = ConnectionPool(
+                    min_size=int(get_variable('POOL_MIN_SIZE', '1')),
+                    max_size=int(get_variable('POOL_MAX_SIZE', '4')),
+                    ping_interval=float(get_variable('POOL_PING_INTERVAL', '30')),
+                    timeout=int(get_variable('TIMEOUT', '10')),
+                    host=get_variable('HOST'),
+                    port=int(get_variable('PORT', '3306')),
+                    user=get_variable('USERNAME'),
+                    password=get_variable('PASSWORD'),
+                    database=get_variable('DATABASE'),
+                    connect_timeout=int(get_variable('TIMEOUT', '10')),
+                    local_infile=self.batch_infile_threshold > 0,
+                )
+            except (MySQLdb.OperationalError, MySQLdb.Error) as e:
+                raise RecoverableConnectorError(f"Failed to connect to database: {e}")
 
-        :return: connection: a new connection object to the database
+    def get_connection(self):
         """
+        Borrow a connection from the pool
 
-        self.connection = None
+        :return: a connection to the database, which must be returned to the pool using `self.pool.put`
+        """
+
+        # Including the connect in the borrow method such that it can benefit from retrying
+        if not self.pool:
+            self.connect()
 
         try:
-            self.connection = MySQLdb.connect(
-                host=get_variable('HOST'),
-                port=int(get_variable('PORT', '3306')),
-                user=get_variable('USERNAME'),
-                password=get_variable('PASSWORD'),
-                database=get_variable('DATABASE'),
-                connect_timeout=int(get_variable('TIMEOUT', '10')),
-            )
-        except (MySQLdb.OperationalError, MySQLdb.Error) as e:
+            return self.pool.get()
+        except MySQLdb.Error as e:
             raise RecoverableConnectorError(f"Failed to connect to database: {e}")
 
-    @retry(attempts=3)
     def insert(self, data):
         """
-        Insert given data to MySQL
+        Insert given data to MySQL. A list of rows is written as a single batch. When buffered inserts are enabled,
+        the data is added to the buffer and the buffer is flushed once it is full or too old.
 
-        :param dict data: a dictionary containing the data to be inserted
+        :param dict|list data: a dictionary containing the data to be inserted, or a list of those dictionaries
         """
 
-        # Including the connect in the insert method such that it can benefit from retrying
-        if not self.connection:
-            self.connect()
+        if isinstance(data, dict) and self.batch_size <= 1:
+            self.insert_row(data)
+            return
+
+        rows = data if isinstance(data, list) else [data]
 
-        # Construct the insert query
-        columns = ", ".join([f"{col}" for col in data.keys()])
-        values = ", ".join(["%s" for _ in data])
-        query = f"INSERT INTO {get_variable('TABLE')} ({columns}) " \
-                f"VALUES ({values})"
+        with self.buffer_lock:
+            if not self.buffer:
+                self.buffer_started = time.monotonic()
+            self.buffer.extend(rows)
+
+            age = time.monotonic() - self.buffer_started
+            full = len(self.buffer) >= self.batch_size or age >= self.batch_max_age
+            self._schedule_flush(self.batch_max_age - age)
+
+        if full:
+            self.flush()
+
+    def _schedule_flush(self, delay):
+        """
+        Start a background timer that flushes the buffer once the oldest buffered row reaches the maximum age, such
+        that the rows are written when no more data arrives. Must be called while holding the buffer lock.
+
+        :param float delay: number of seconds after which the timer fires
+        """
+
+        if self.flush_timer is None:
+            self.flush_timer = threading.Timer(max(delay, 0), self._flush_on_timer)
+            self.flush_timer.daemon = True
+            self.flush_timer.start()
+
+    def _flush_on_timer(self):
+        """
+        Flush the buffer if its oldest row reached the maximum age. Otherwise, the buffer was flushed and refilled
+        since the timer was started, and the timer is restarted for the remaining time of the current buffer.
+        """
+
+        with self.buffer_lock:
+            self.flush_timer = None
+            if not self.buffer:
+                return
+
+            remaining = self.batch_max_age - (time.monotonic() - self.buffer_started)
+            if remaining > 0:
+                self._schedule_flush(remaining)
+                return
+
+        try:
+            self.flush()
+        except ConnectorError as e:
+            logger.error(f"Failed to write buffered rows: {e}")
+
+        # Rows that could not be written are retried once the maximum age has passed again
+        with self.buffer_lock:
+            if self.buffer:
+                self._schedule_flush(self.batch_max_age)
+
+    @retry(attempts=3)
+    def insert_row(self, data):
+        """
+        Insert a single row to MySQL
 
+        :param dict data: a dictionary containing the data to be inserted
+        """
+
+        query = self._get_statement(tuple(data.keys()))
         params = tuple(data.values())
 
+        connection = self.get_connection()
+        close = False
+
         try:
-            cursor = self.connection.cursor()
+            cursor = connection.cursor()
             cursor.execute(query, params)
-            self.connection.commit()
+            connection.commit()
             cursor.close()
 
-        except MySQLdb.OperationalError as e:
-            self.connection = None
-            raise RecoverableConnectorError(f"Failed to insert data: {e}")
-
         except MySQLdb.Error as e:
-            self.connection = None
+            close = True
+            if self._is_connection_error(e):
+                raise RecoverableConnectorError(f"Failed to insert data: {e}")
             raise ConnectorError(f"Failed to insert data: {e}")
 
+        finally:
+            self.pool.put(connection, close=close)
+
         logger.info("Data inserted successfully")
 
+    @retry(attempts=3)
+    def flush(self):
+        """
+        Write all buffered rows to MySQL in a single transaction. Rows are written with multi-row INSERT statements
+        that are split to fit in max_allowed_packet, or with LOAD DATA LOCAL INFILE for large batches. If the batch is
+        rejected, it is split in halves that are retried separately, such that only the invalid rows are rejected. If
+        the flush fails due to lost database connection, retry flushing the rows that were not written yet.
+        """
+
+        with self.buffer_lock:
+            if not self.buffer:
+                return
+
+            rows = self.buffer
+            rejected = []
+            written = 0
+            started = time.monotonic()
+
+            connection = self.get_connection()
+            close = False
+
+            # Process the buffer as a stack of (start, end) slices. Slices are handled in order, so the rows that were
+            # either written or rejected always form the head of the buffer.
+            slices = [(0, len(rows))]
+
+            try:
+                if self.max_statement_length is None:
+                    cursor = connection.cursor()
+                    cursor.execute("SELECT @@max_allowed_packet")
+                    self.max_statement_length = int(cursor.fetchone()[0]) - PACKET_MARGIN
+                    cursor.close()
+
+                while slices:
+                    start, end = slices.pop()
+
+                    try:
+                        self._write_rows(connection, rows[start:end])
+                        connection.commit()
+
+                    except MySQLdb.Error as e:
+                        if self._is_connection_error(e):
+                            raise
+                        error = e
+
+                    except (ConnectorError, ValueError, TypeError) as e:
+                        error = e
+
+                    else:
+                        written = end
+                        continue
+
+                    connection.rollback()
+
+                    if end - start == 1:
+                        logger.error(f"Rejected row {rows[start]}: {error}")
+                        rejected.append(error)
+                        written = end
+                    else:
+                        middle = (start + end) // 2
+                        slices.extend([(middle, end), (start, middle)])
+
+            except MySQLdb.Error as e:
+                close = True
+                self.buffer = rows[written:]
+                raise RecoverableConnectorError(f"Failed to insert data: {e}")
+
+            finally:
+                self.pool.put(connection, close=close)
+
+            self.buffer = []
+            self.buffer_started = None
+
+        duration = time.monotonic() - started
+        logger.info(f"Inserted {len(rows) - len(rejected)} rows in {duration:.3f} seconds")
+
+        if rejected:
+            raise ConnectorError(f"Failed to insert {len(rejected)} of {len(rows)} rows: {rejected[0]}")
+
+    def _write_rows(self, connection, rows):
+        """
+        Write the given rows in the current transaction, without committing. Consecutive rows with the same columns
+        are written together.
+
+        :param connection: the connection to write the rows with
+        :param list rows: a list of dictionaries containing the data to be inserted
+        """
+
+        use_infile = 0 < self.batch_infile_threshold <= len(rows)
+
+        cursor = connection.cursor()
+
+        # Let MySQLdb combine the rows into multi-row INSERT statements that fit in max_allowed_packet
+        cursor.max_stmt_length = self.max_statement_length
+
+        group_start = 0
+        for index in range(1, len(rows) + 1):
+            if index < len(rows) and tuple(rows[index].keys()) == tuple(rows[group_start].keys()):
+                continue
+
+            group = rows[group_start:index]
+            columns = tuple(group[0].keys())
+
+            if use_infile and all(self._infile_compatible(value) for row in group for value in row.values()):
+                with tempfile.NamedTemporaryFile(mode='w', encoding='utf-8', suffix='.tsv') as infile:
+                    infile.writelines(self._infile_line(row) for row in group)
+                    infile.flush()
+
+                    cursor.execute(
+                        f"LOAD DATA LOCAL INFILE %s INTO TABLE {self.table} CHARACTER SET utf8mb4 "
+                        f"({', '.join(columns)})",
+                        (infile.name,)
+                    )
+
+                # With LOCAL, duplicate keys and invalid values are warnings instead of errors, and the rows are
+                # skipped or converted. Fail the batch instead, like the INSERT statements would.
+                warnings = connection.warning_count()
+                if cursor.rowcount != len(group) or warnings:
+                    message = f"loaded {cursor.rowcount} of {len(group)} rows with {warnings} warnings"
+                    if warnings:
+                        cursor.execute("SHOW WARNINGS LIMIT 1")
+                        message += f", first warning: {cursor.fetchone()[2]}"
+                    raise ConnectorError(f"LOAD DATA {message}")
+            else:
+                cursor.executemany(self._get_statement(columns), [tuple(row.values()) for row in group])
+
+            group_start = index
+
+        cursor.close()
+
+    @staticmethod
+    def _is_connection_error(error):
+        """
+        Check whether the given error is caused by a failed or lost connection, such that the statement can be retried
+        on a new connection
+
+        :param MySQLdb.Error error: the error raised by MySQLdb
+        :return bool: whether the error is a connection error
+        """
+
+        if isinstance(error, MySQLdb.InterfaceError):
+            return True
+        return isinstance(error, MySQLdb.OperationalError) and bool(error.args) and error.args[0] in CONNECTION_ERRORS
+
+    @staticmethod
+    def _infile_compatible(value):
+        """
+        Check whether the given value can be written using LOAD DATA
+
+        :param value: a value to be inserted
+        :return bool: whether the value can be written using LOAD DATA
+        """
+
+        return value is None or isinstance(value, INFILE_TYPES)
+
+    @staticmethod
+    def _infile_line(row):
+        """
+        Encode a row as a line in the default tab-separated format of LOAD DATA
+
+        :param dict row: a dictionary containing the data to be inserted
+        :return str: the encoded line, including the trailing newline
+        """
+
+        values = []
+        for value in row.values():
+            if value is None:
+                values.append("\\N")
+                continue
+
+            if isinstance(value, bool):
+                value = int(value)
+
+            values.append(
+                str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+                .replace("\0", "\\0")
+            )
+
+        return "\t".join(values) + "\n"
+
+    def _get_statement(self, columns):
+        """
+        Get the query to insert a row with the given columns. The query is constructed the first time a combination
+        of columns is seen, after which it is taken from the cache.
+
+        :param tuple columns: the names of the columns to insert
+        :return str: the query to execute with the values of the row as parameters
+        """
+
+        with self.statement_lock:
+            query = self.statements.get(columns)
+            if query:
+                self.statements.move_to_end(columns)
+                self.statement_hits += 1
+                return query
+
+            self.statement_misses += 1
+
+            values = ", ".join(["%s" for _ in columns])
+            query = f"INSERT INTO {self.table} ({', '.join(columns)}) VALUES ({values})"
+
+            if self.statement_cache_size > 0:
+                self.statements[columns] = query
+                if len(self.statements) > self.statement_cache_size:
+                    self.statements.popitem(last=False)
+
+                logger.info(f"Cached insert statement for columns {columns} (cache hits: {self.statement_hits}, "
+                            f"misses: {self.statement_misses})")
+
+        return query
+
     def stop(self):
         """
-        Close connection to the database if the connection has been initialised
+        Write the remaining buffered rows and close the connections to the database if the pool has been initialised
         """
 
+        with self.buffer_lock:
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+
+        try:
+            self.flush()
+        except ConnectorError as e:
+            logger.error(f"Failed to write buffered rows on stop: {e}")
+
+        if self.statement_cache_size > 0:
+            logger.info(f"Insert statement cache hits: {self.statement_hits}, misses: {self.statement_misses}")
+
         try:
-            self.connection.close()
-        except (AttributeError, MySQLdb.Error):
+            self.pool.close()
+        except AttributeError:
             pass
 
-        self.connection = None
+        self.pool = None
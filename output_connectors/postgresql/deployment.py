@@ -1,11 +1,37 @@
+import collections
+import datetime
+import decimal
+import io
+import itertools
 import logging
+import threading
+import time
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
 
 from ubiops_connector import OutputConnector, ConnectorError, RecoverableConnectorError, get_variable, retry
 
 
 logger = logging.getLogger('PostgreSQL Connector')
 
+# Value types that can be written with COPY without relying on the type adaptation of psycopg2
+COPY_TYPES = (str, int, float, decimal.Decimal, datetime.date, datetime.time, datetime.timedelta)
+
+
+class Connection(psycopg2.extensions.connection):
+    """
+    PostgreSQL connection that keeps track of the statements prepared in its session and of the last time it was used
+    """
+
+    def __init__(self, *args, **kwargs):
+        psycopg2.extensions.connection.__init__(self, *args, **kwargs)
+
+        # Prepared insert statements keyed by the tuple of column names, ordered from least to most recently used
+        self.statements = collections.OrderedDict()
+        self.last_used = time.monotonic()
+
 
 class Deployment(OutputConnector):
     """
@@ -20,74 +46,406 @@ class Deployment(OutputConnector):
 
         OutputConnector.__init__(self, base_directory, context)
 
-        # Initialize a connection object. It will be set by the connect method.
-        self.connection = None
+        # Initialize a connection pool object. It will be set by the connect method.
+        self.pool = None
+        self.pool_lock = threading.Lock()
+
+        # Connections that have been idle for longer than the ping interval are validated before they are used. The
+        # semaphore makes threads wait for a connection to be returned when all connections of the pool are in use.
+        self.pool_min_size = int(get_variable('POOL_MIN_SIZE', '1'))
+        self.pool_max_size = int(get_variable('POOL_MAX_SIZE', '4'))
+        self.pool_ping_interval = float(get_variable('POOL_PING_INTERVAL', '30'))
+        self.pool_semaphore = threading.BoundedSemaphore(self.pool_max_size)
+
+        self.table = f"{get_variable('SCHEMA', 'public')}.{get_variable('TABLE')}"
+
+        # Prepared insert statements are cached per connection. The cache is disabled when its size is set to 0.
+        self.statement_cache_size = int(get_variable('STATEMENT_CACHE_SIZE', '32'))
+        self.statement_counter = itertools.count(1)
+        self.statement_hits = 0
+        self.statement_misses = 0
+
+        # Buffered inserts are enabled when the batch size is larger than 1. Rows are then collected in the buffer
+        # and written in a single transaction once the batch is full or the oldest row exceeds the maximum age.
+        self.batch_size = int(get_variable('BATCH_SIZE', '1'))
+        self.batch_max_age = float(get_variable('BATCH_MAX_AGE', '5'))
+        self.batch_method = get_variable('BATCH_METHOD', 'copy').lower()
+        self.buffer = []
+        self.buffer_started = None
+        self.buffer_lock = threading.Lock()
+        self.flush_timer = None
 
     def connect(self):
         """
-        Connect to PostgreSQL database
+        Create a pool of connections to the PostgreSQL database
+        """
+
+        with self.pool_lock:
+            if self.pool:
+                return
+
+            try:
+                self.pool = psycopg2.pool.ThreadedConnectionPool(
+                    minconn=self.pool_min_size,
+                    maxconn=self.pool_max_size,
+                    connection_factory=Connection,
+                    host=get_variable('HOST'),
+                    port=int(get_variable('PORT', '5432')),
+                    user=get_variable('USERNAME'),
+                    password=get_variable('PASSWORD'),
+                    database=get_variable('DATABASE'),
+                    connect_timeout=int(get_variable('TIMEOUT', '10'))
+                )
+            except psycopg2.Error as e:
+                raise RecoverableConnectorError(f"Failed to connect to database: {e}")
+
+    def get_connection(self):
+        """
+        Borrow a connection from the pool. Connections that have been idle for longer than the ping interval are
+        validated first. A broken connection is closed and replaced by a new connection, without affecting the other
+        connections in the pool.
 
-        :return: connection: a new connection object to the database
+        :return Connection: a connection to the database, which must be returned using `put_connection`
         """
 
-        self.connection = None
+        # Including the connect in the borrow method such that it can benefit from retrying
+        if not self.pool:
+            self.connect()
+
+        if not self.pool_semaphore.acquire(timeout=int(get_variable('TIMEOUT', '10'))):
+            raise RecoverableConnectorError("Timed out waiting for a connection from the pool")
 
         try:
-            self.connection = psycopg2.connect(
-                host=get_variable('HOST'),
-                port=int(get_variable('PORT', '5432')),
-                user=get_variable('USERNAME'),
-                password=get_variable('PASSWORD'),
-                database=get_variable('DATABASE'),
-                connect_timeout=int(get_variable('TIMEOUT', '10'))
-            )
+            connection = self.pool.getconn()
+
+            if connection.closed or time.monotonic() - connection.last_used >= self.pool_ping_interval:
+                try:
+                    cursor = connection.cursor()
+                    cursor.execute("SELECT 1")
+                    cursor.close()
+                    connection.rollback()
+                except psycopg2.Error as e:
+                    logger.warning(f"Replacing broken connection: {e}")
+                    self.pool.putconn(connection, close=True)
+                    connection = self.pool.getconn()
+
         except psycopg2.Error as e:
+            self.pool_semaphore.release()
             raise RecoverableConnectorError(f"Failed to connect to database: {e}")
 
-    @retry(attempts=3)
+        return connection
+
+    def put_connection(self, connection, close=False):
+        """
+        Return a borrowed connection to the pool
+
+        :param Connection connection: the connection that was borrowed using `get_connection`
+        :param bool close: whether to close the connection, such that the pool replaces it by a new connection
+        """
+
+        connection.last_used = time.monotonic()
+
+        try:
+            self.pool.putconn(connection, close=close or bool(connection.closed))
+        except (AttributeError, psycopg2.Error):
+            # The pool was closed in the meantime
+            pass
+        finally:
+            self.pool_semaphore.release()
+
     def insert(self, data):
         """
-        Insert given data to PostgreSQL. If the insert fails due to lost database connection, retry inserting.
+        Insert given data to PostgreSQL. When buffered inserts are enabled, the data is added to the buffer and the
+        buffer is flushed once it is full or too old.
 
-        :param dict data: a dictionary containing the data to be inserted
+        :param dict|list data: a dictionary containing the data to be inserted, or a list of those dictionaries
         """
 
-        # Including the connect in the insert method such that it can benefit from retrying
-        if not self.connection:
-            self.connect()
+        rows = data if isinstance(data, list) else [data]
+
+        if self.batch_size <= 1:
+            for row in rows:
+                self.insert_row(row)
+            return
+
+        with self.buffer_lock:
+            if not self.buffer:
+                self.buffer_started = time.monotonic()
+            self.buffer.extend(rows)
+
+            age = time.monotonic() - self.buffer_started
+            full = len(self.buffer) >= self.batch_size or age >= self.batch_max_age
+            self._schedule_flush(self.batch_max_age - age)
+
+        if full:
+            self.flush()
 
-        # Construct the insert query
-        columns = ", ".join([f"{col}" for col in data.keys()])
-        values = ", ".join(["%s" for _ in data])
-        query = f"INSERT INTO {get_variable('SCHEMA', 'public')}.{get_variable('TABLE')} ({columns}) " \
-                f"VALUES ({values})"
+    def _schedule_flush(self, delay):
+        """
+        Start a background timer that flushes the buffer once the oldest buffered row reaches the maximum age, such
+        that the rows are written when no more data arrives. Must be called while holding the buffer lock.
+
+        :param float delay: number of seconds after which the timer fires
+        """
+
+        if self.flush_timer is None:
+            self.flush_timer = threading.Timer(max(delay, 0), self._flush_on_timer)
+            self.flush_timer.daemon = True
+            self.flush_timer.start()
+
+    def _flush_on_timer(self):
+        """
+        Flush the buffer if its oldest row reached the maximum age. Otherwise, the buffer was flushed and refilled
+        since the timer was started, and the timer is restarted for the remaining time of the current buffer.
+        """
+
+        with self.buffer_lock:
+            self.flush_timer = None
+            if not self.buffer:
+                return
+
+            remaining = self.batch_max_age - (time.monotonic() - self.buffer_started)
+            if remaining > 0:
+                self._schedule_flush(remaining)
+                return
+
+        try:
+            self.flush()
+        except ConnectorError as e:
+            logger.error(f"Failed to write buffered rows: {e}")
+
+        # Rows that could not be written are retried once the maximum age has passed again
+        with self.buffer_lock:
+            if self.buffer:
+                self._schedule_flush(self.batch_max_age)
+
+    @retry(attempts=3)
+    def insert_row(self, data):
+        """
+        Insert a single row to PostgreSQL. If the insert fails due to lost database connection, retry inserting.
+
+        :param dict data: a dictionary containing the data to be inserted
+        """
 
         params = tuple(data.values())
 
+        connection = self.get_connection()
+        close = False
+
         try:
-            cursor = self.connection.cursor()
+            cursor = connection.cursor()
+            query = self._get_statement(connection, cursor, tuple(data.keys()))
             cursor.execute(query, params)
-            self.connection.commit()
+            connection.commit()
             cursor.close()
 
-        except psycopg2.OperationalError as e:
-            self.connection = None
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            close = True
             raise RecoverableConnectorError(f"Failed to insert data: {e}")
 
         except psycopg2.Error as e:
-            self.connection = None
             raise ConnectorError(f"Failed to insert data: {e}")
 
+        finally:
+            self.put_connection(connection, close=close)
+
         logger.info("Data inserted successfully")
 
+    def _get_statement(self, connection, cursor, columns):
+        """
+        Get the query to insert a row with the given columns. The insert statement is prepared on the server the
+        first time a combination of columns is seen, after which the query only executes the prepared statement.
+
+        :param Connection connection: the connection to prepare the statement in
+        :param cursor: the cursor to prepare the statement with
+        :param tuple columns: the names of the columns to insert
+        :return str: the query to execute with the values of the row as parameters
+        """
+
+        statement = connection.statements.get(columns)
+        if statement:
+            connection.statements.move_to_end(columns)
+            self.statement_hits += 1
+            return statement[1]
+
+        placeholders = ", ".join(["%s" for _ in columns])
+
+        if self.statement_cache_size <= 0:
+            return f"INSERT INTO {self.table} ({', '.join(columns)}) VALUES ({placeholders})"
+
+        self.statement_misses += 1
+        name = f"ubiops_insert_{next(self.statement_counter)}"
+
+        parameters = ", ".join([f"${index}" for index in range(1, len(columns) + 1)])
+        cursor.execute(f"PREPARE {name} AS INSERT INTO {self.table} ({', '.join(columns)}) VALUES ({parameters})")
+        connection.statements[columns] = (name, f"EXECUTE {name} ({placeholders})")
+
+        if len(connection.statements) > self.statement_cache_size:
+            _, (evicted, _) = connection.statements.popitem(last=False)
+            cursor.execute(f"DEALLOCATE {evicted}")
+
+        logger.info(f"Prepared insert statement {name} (cache hits: {self.statement_hits}, "
+                    f"misses: {self.statement_misses})")
+
+        return connection.statements[columns][1]
+
+    @retry(attempts=3)
+    def flush(self):
+        """
+        Write all buffered rows to PostgreSQL in a single transaction. If the batch is rejected, it is split in halves
+        that are retried separately, such that only the invalid rows are rejected. If the flush fails due to lost
+        database connection, retry flushing the rows that were not written yet.
+        """
+
+        with self.buffer_lock:
+            if not self.buffer:
+                return
+
+            rows = self.buffer
+            rejected = []
+            written = 0
+            started = time.monotonic()
+
+            connection = self.get_connection()
+            close = False
+
+            # Process the buffer as a stack of (start, end) slices. Slices are handled in order, so the rows that were
+            # either written or rejected always form the head of the buffer.
+            slices = [(0, len(rows))]
+
+            try:
+                while slices:
+                    start, end = slices.pop()
+
+                    try:
+                        self._write_rows(connection, rows[start:end])
+                        connection.commit()
+
+                    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                        raise
+
+                    except (psycopg2.Error, ValueError, TypeError) as e:
+                        connection.rollback()
+
+                        if end - start == 1:
+                            logger.error(f"Rejected row {rows[start]}: {e}")
+                            rejected.append(e)
+                        else:
+                            middle = (start + end) // 2
+                            slices.extend([(middle, end), (start, middle)])
+                            continue
+
+                    written = end
+
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                close = True
+                self.buffer = rows[written:]
+                raise RecoverableConnectorError(f"Failed to insert data: {e}")
+
+            finally:
+                self.put_connection(connection, close=close)
+
+            self.buffer = []
+            self.buffer_started = None
+
+        duration = time.monotonic() - started
+        logger.info(f"Inserted {len(rows) - len(rejected)} rows in {duration:.3f} seconds")
+
+        if rejected:
+            raise ConnectorError(f"Failed to insert {len(rejected)} of {len(rows)} rows: {rejected[0]}")
+
+    def _write_rows(self, connection, rows):
+        """
+        Write the given rows in the current transaction, without committing. Consecutive rows with the same columns
+        are written together using COPY. Rows containing values that cannot be written with COPY are inserted with
+        a multi-row INSERT statement instead.
+
+        :param Connection connection: the connection to write the rows with
+        :param list rows: a list of dictionaries containing the data to be inserted
+        """
+
+        cursor = connection.cursor()
+
+        group_start = 0
+        for index in range(1, len(rows) + 1):
+            if index < len(rows) and tuple(rows[index].keys()) == tuple(rows[group_start].keys()):
+                continue
+
+            group = rows[group_start:index]
+            columns = ", ".join([f"{col}" for col in group[0].keys()])
+
+            if self.batch_method == 'copy' and all(self._copyable(value) for row in group for value in row.values()):
+                cursor.copy_expert(
+                    sql=f"COPY {self.table} ({columns}) FROM STDIN",
+                    file=io.StringIO("".join(self._copy_line(row) for row in group))
+                )
+            else:
+                psycopg2.extras.execute_values(
+                    cursor, f"INSERT INTO {self.table} ({columns}) VALUES %s",
+                    [tuple(row.values()) for row in group],
+                    page_size=len(group)
+                )
+
+            group_start = index
+
+        cursor.close()
+
+    @staticmethod
+    def _copyable(value):
+        """
+        Check whether the given value can be written using the text format of COPY
+
+        :param value: a value to be inserted
+        :return bool: whether the value can be written using COPY
+        """
+
+        return value is None or isinstance(value, COPY_TYPES)
+
+    @staticmethod
+    def _copy_line(row):
+        """
+        Encode a row as a line in the text format of COPY
+
+        :param dict row: a dictionary containing the data to be inserted
+        :return str: the encoded line, including the trailing newline
+        """
+
+        values = []
+        for value in row.values():
+            if value is None:
+                values.append("\\N")
+                continue
+
+            if isinstance(value, (datetime.date, datetime.time)):
+                value = value.isoformat()
+
+            values.append(
+                str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+            )
+
+        return "\t".join(values) + "\n"
+
     def stop(self):
         """
-        Close connection to the database if the connection has been initialised
+        Write the remaining buffered rows and close the connections to the database if the pool has been initialised
         """
 
+        with self.buffer_lock:
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+
+        try:
+            self.flush()
+        except ConnectorError as e:
+            logger.error(f"Failed to write buffered rows on stop: {e}")
+
+        if self.statement_cache_size > 0:
+            logger.info(f"Insert statement cache hits: {self.statement_hits}, misses: {self.statement_misses}")
+
         try:
-            self.connection.close()
+            self.pool.closeall()
         except (AttributeError, psycopg2.Error):
             pass
 
-        self.connection = None
+        self.pool = None